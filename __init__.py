@@ -0,0 +1,19 @@
+
+# The parsers (ber, emv, tag, apdu) can be imported without pyscard.
+# The reader backend is only imported the first time one of these is used.
+BACKEND = [
+    'Pcsc',
+    'ReaderRegistry',
+    'registry',
+    'PcscReader',
+    'BasicChipReader',
+    'LowLevelChipReader',
+    'AcsReader',
+    'Pn532',
+]
+
+def __getattr__(name):
+    if name in BACKEND:
+        from . import rfid
+        return getattr(rfid, name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Application discovery, for when we don't know what's on a card.
+
+PPSE comes first, as it lists every contactless application in one SELECT.
+Failing that, we try the AIDs earlier cards of the same family (SEL_RES
+and ATS) had, then the known AIDs, kept in a prefix trie. Where a RID has
+several AIDs, one partial SELECT walked with 'next' can replace them, if
+the card supports that, which is remembered for each family.
+
+Sources:
+https://www.eftlab.com.au/index.php/site-map/knowledge-base/211-emv-aid-rid-pix
+EMV Book 1, 12.3.3 (Using a List of AIDs)
+"""
+
+import threading
+from .common import toHexString, toASCIIBytes
+from .apdu import APDU
+from .emv import EMVException
+
+PPSE = toASCIIBytes('2PAY.SYS.DDF01')
+
+
+class AIDNode(object):
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # Name, if an AID ends here
+        self.name = None
+        self.children = {}
+
+    def __repr__(self):
+        return '<AIDNode %s>' % toHexString(self.prefix)
+
+    def aids(self):
+        if self.name is not None:
+            yield self.prefix, self.name
+        for byte in sorted(self.children):
+            for aid in self.children[byte].aids():
+                yield aid
+
+
+class AIDTrie(object):
+    """
+    Known AIDs by prefix, for naming partial and extended AIDs (see Discovery).
+
+    >>> trie = AIDTrie(([0xa0, 0x00, 0x00, 0x00, 0x03, 0x10, 0x10], 'Visa'),
+    ...                ([0xa0, 0x00, 0x00, 0x00, 0x03, 0x20, 0x10], 'Visa Electron'))
+
+    Names come from the longest known AID, so they work for extended AIDs.
+
+    >>> trie.name([0xa0, 0x00, 0x00, 0x00, 0x03, 0x10, 0x10, 0x01])
+    'Visa'
+    >>> [0xa0, 0x00, 0x00, 0x00, 0x03] in trie
+    False
+    >>> trie.node([0xa0, 0x00, 0x00, 0x00, 0x03])
+    <AIDNode A0 00 00 00 03>
+    >>> [name for aid, name in trie]
+    ['Visa', 'Visa Electron']
+    """
+    def __init__(self, *aids):
+        self.root = AIDNode([])
+        for aid, name in aids:
+            self.add(aid, name)
+
+    def add(self, aid, name):
+        node = self.root
+        for byte in aid:
+            child = node.children.get(byte)
+            if child is None:
+                child = node.children[byte] = AIDNode(node.prefix + [byte])
+            node = child
+        if node.name is None:
+            node.name = name
+
+    def node(self, prefix):
+        node = self.root
+        for byte in prefix:
+            node = node.children.get(byte)
+            if node is None:
+                return None
+        return node
+
+    def name(self, aid):
+        # Name of the longest known AID that aid starts with
+        node = self.root
+        name = None
+        for byte in aid:
+            node = node.children.get(byte)
+            if node is None:
+                break
+            if node.name is not None:
+                name = node.name
+        return name
+
+    def __contains__(self, aid):
+        node = self.node(aid)
+        return node is not None and node.name is not None
+
+    def __iter__(self):
+        return self.root.aids()
+
+
+AIDS = AIDTrie(
+    ([0xa0, 0x00, 0x00, 0x00, 0x03, 0x10, 0x10], 'Visa'),
+    ([0xa0, 0x00, 0x00, 0x00, 0x03, 0x20, 0x10], 'Visa Electron'),
+    ([0xa0, 0x00, 0x00, 0x00, 0x03, 0x20, 0x20], 'V PAY'),
+    ([0xa0, 0x00, 0x00, 0x00, 0x03, 0x80, 0x02], 'Visa CAP'),
+    ([0xa0, 0x00, 0x00, 0x00, 0x04, 0x10, 0x10], 'MasterCard'),
+    ([0xa0, 0x00, 0x00, 0x00, 0x04, 0x30, 0x60], 'Maestro'),
+    ([0xa0, 0x00, 0x00, 0x00, 0x04, 0x80, 0x02], 'MasterCard CAP'),
+    ([0xa0, 0x00, 0x00, 0x00, 0x25, 0x01], 'American Express'),
+    ([0xa0, 0x00, 0x00, 0x00, 0x65, 0x10, 0x10], 'JCB'),
+    ([0xa0, 0x00, 0x00, 0x01, 0x52, 0x30, 0x10], 'Discover'),
+    ([0xa0, 0x00, 0x00, 0x02, 0x77, 0x10, 0x10], 'Interac'),
+    ([0xa0, 0x00, 0x00, 0x03, 0x33, 0x01, 0x01], 'UnionPay'),
+)
+
+
+# Registered application provider identifier, the first part of every AID
+RID_LENGTH = 5
+
+class Discovery(object):
+    """
+    Finds the applications on a card, with as few SELECTs as we can manage.
+
+    apps(emv) returns (priority, name, aid) for each application, like
+    parse_app. Priority is None unless it came from PPSE.
+
+    Without PPSE, the AIDs found on earlier cards of the same family
+    (SEL_RES and ATS) are tried first, as they tend to carry the same
+    applications. Failing that, known AIDs are selected from the trie. A
+    partial SELECT of the RID, walked with 'next', only replaces the
+    SELECTs for a RID with several AIDs, and is skipped altogether for
+    families that have turned out not to support it.
+    """
+    def __init__(self, trie=AIDS, learn=True):
+        self.trie = trie
+        self.learn = learn
+        self.lock = threading.Lock()
+        # Family to whether its cards take partial AIDs (None if we don't know)
+        self.partial = {}
+        # Family to the AIDs found on the last card
+        self.seen = {}
+        self.selects = 0
+
+    def family(self, emv):
+        tag = emv.tag
+        return getattr(tag, 'sel_res', None), tuple(getattr(tag, 'ats', None) or [])
+
+    def select(self, emv, aid, which='first'):
+        # Returns the full AID selected, or None if there's nothing there.
+        # Cards answer a partial AID they don't like with all sorts of
+        # statuses (6A82, 6A86, 6D00...), so anything but 9000 is a miss,
+        # as is an FCI we can't make sense of
+        self.selects += 1
+        try:
+            emv.select_by_df(aid, which)
+        except EMVException:
+            return None
+        except (KeyError, ValueError, IndexError, EOFError):
+            emv.invalidate()
+            return None
+        return list(emv.aid)
+
+    def ppse(self, emv):
+        self.selects += 1
+        try:
+            resp = emv.send(APDU(0, 0xa4, 4, 0, data=PPSE))
+            issuer = emv.BER(resp)['FCI']['FCI_ISSUER']
+            if 'FCI_EXTRA' not in issuer:
+                return None
+            return issuer['FCI_EXTRA'].getlistparsed('APP') or None
+        except (EMVException, KeyError, ValueError, IndexError, EOFError):
+            return None
+
+    def walk_prefix(self, emv, prefix):
+        # Everything under a partial AID, using 'next'
+        found = []
+        aid = self.select(emv, prefix)
+        while aid is not None and aid not in found:
+            found.append(aid)
+            aid = self.select(emv, prefix, 'next')
+        return found
+
+    def select_each(self, emv, aids):
+        # Whole AIDs, one SELECT each
+        found = []
+        for aid in aids:
+            aid = self.select(emv, aid)
+            if aid is not None and aid not in found:
+                found.append(aid)
+        return found
+
+    def rids(self):
+        # Known AIDs grouped by RID, in trie order
+        groups = []
+        for aid, name in self.trie:
+            rid = aid[:RID_LENGTH]
+            if groups and groups[-1][0] == rid:
+                groups[-1][1].append(aid)
+            else:
+                groups.append((rid, [aid]))
+        return groups
+
+    def walk(self, emv, partial):
+        # Returns what's found, and whether the card takes partial AIDs
+        found = []
+        for rid, aids in self.rids():
+            if len(aids) > 1 and partial is not False:
+                more = self.walk_prefix(emv, rid)
+                if more:
+                    partial = True
+                    found += [aid for aid in more if aid not in found]
+                    continue
+                if partial:
+                    # It would have found them, so nothing's here
+                    continue
+
+            more = self.select_each(emv, aids)
+            if more and len(aids) > 1 and partial is None:
+                # The partial SELECT missed something that's there
+                partial = False
+            found += [aid for aid in more if aid not in found]
+        return found, partial
+
+    def apps(self, emv, ppse=True):
+        if ppse:
+            apps = self.ppse(emv)
+            if apps:
+                return apps
+
+        family = self.family(emv)
+        with self.lock:
+            partial = self.partial.get(family)
+            seen = list(self.seen.get(family, []))
+
+        found = self.select_each(emv, seen)
+        if not found:
+            found, partial = self.walk(emv, partial)
+
+        if self.learn:
+            with self.lock:
+                if partial is not None:
+                    self.partial[family] = partial
+                if found:
+                    self.seen[family] = found
+
+        apps = []
+        for aid in found:
+            name = self.trie.name(aid)
+            if name is None:
+                name = 'Unknown'
+                if self.learn:
+                    with self.lock:
+                        self.trie.add(aid, name)
+            apps.append((None, name, aid))
+        return apps
+
+
+# Shared by all readers, so what's learnt from one card helps the next
+discovery = Discovery()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
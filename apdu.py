@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# No pyscard in here, so commands can be built without a reader
+
+class APDU(object):
+    def __init__(self, cls, ins, p1=0, p2=0, lc=None, data=None, le=None):
+        self.cls = cls
+        self.ins = ins
+        self.p1 = p1
+        self.p2 = p2
+        if data is None:
+            data = []
+        self.data = data
+        if lc is None:
+            lc = len(data)
+        self.lc = lc
+        self.le = []
+        if le is not None:
+            self.le = [le]
+
+    @property
+    def bytes(self):
+        if len(self.data) > 255:
+            raise ValueError('APDU payload too long')
+        return [self.cls, self.ins, self.p1, self.p2, self.lc] + self.data + self.le
+
+    def __iter__(self):
+        return iter(self.bytes)
+
+    @classmethod
+    def frombytes(self, bytes):
+        args = bytes[:5]
+        lc = bytes[4]
+        if 5 + lc != len(bytes):
+            raise ValueError('Length %s is incorrect for APDU length %s' % (5 + lc, len(bytes)))
+        args.append(bytes[5:])
+        return APDU(*args)
+
+    def on_channel(self, channel):
+        return APDU(channel_cla(self.cls, channel), self.ins, self.p1, self.p2,
+                    lc=self.lc, data=self.data, le=self.le[0] if self.le else None)
+
+
+def channel_cla(cla, channel):
+    """
+    ISO7816-4 5.4.1. Channels 0-3 go in b2-b1 (keeping secure messaging
+    in b4-b3), and 4-19 in b4-b1 with b7 set. b8 (proprietary) and b5
+    (chaining) stay as they were.
+
+    >>> '%02x' % channel_cla(0x0c, 1)
+    '0d'
+    >>> '%02x' % channel_cla(0x80, 5)
+    'c1'
+    >>> cla_channel(channel_cla(0x00, 19))
+    19
+    >>> channel_cla(0x00, 20)
+    Traceback (most recent call last):
+        ...
+    ValueError: No logical channel 20
+    """
+    kept = cla & 0x90
+    if channel < 4:
+        return kept | (cla & 0x0c) | channel
+    if channel < 20:
+        return kept | 0x40 | (channel - 4)
+    raise ValueError('No logical channel %s' % channel)
+
+def cla_channel(cla):
+    # Which logical channel a CLA byte is for (the reverse of channel_cla)
+    if cla & 0x40:
+        return 4 + (cla & 0x0f)
+    return cla & 0x03
+
+def on_channel(apdu, channel):
+    # For APDUs or lists of bytes
+    if isinstance(apdu, APDU):
+        return apdu.on_channel(channel)
+    apdu = list(apdu)
+    apdu[0] = channel_cla(apdu[0], channel)
+    return apdu
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
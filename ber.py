@@ -4,9 +4,12 @@ from collections import defaultdict
 try:
     from UserDict import DictMixin
 except ImportError:
-    from collections import MutableMapping as DictMixin
+    # BER is read-only, so we don't need the MutableMapping methods
+    try:
+        from collections.abc import Mapping as DictMixin
+    except ImportError:
+        from collections import Mapping as DictMixin
 
-import pprint
 
 class Tags(object):
     default_parser = repr
@@ -95,7 +98,7 @@ class BER(DictMixin):
     >>> str(ber1['STRING'])
     'Hello!'
 
-    >>> map(int, seq.getlist('INTEGER'))
+    >>> list(map(int, seq.getlist('INTEGER')))
     [30, 50000]
 
     For universal types, there are helpers that do the coercing for you.
@@ -141,7 +144,7 @@ class BER(DictMixin):
         return ' '.join('%02x' % b for b in self._data)
 
     def __repr__(self):
-        return '<BER %s>' % hex(self)
+        return '<BER %s>' % self.__hex__()
 
     def __bool__(self):
         # No need to parse - any valid data will result in a tag
@@ -210,11 +213,17 @@ class BER(DictMixin):
         parser = self.tags.parser(tag)
         return list(map(parser, self.ber.get(tag, [])))
 
+    def __iter__(self):
+        return iter(self.ber)
+
+    def __len__(self):
+        return len(self.ber)
+
     def keys(self):
         return list(self.ber.keys())
 
     def items(self):
-        return [(k, v[0]) for k, v in self.ber]
+        return [(k, v[0]) for k, v in self.ber.items()]
 
     def values(self):
         return [v[0] for v in list(self.ber.values())]
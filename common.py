@@ -1,6 +1,93 @@
-from smartcard.Exceptions import SmartcardException
+
+# Nothing in here (or in ber, emv, tag and apdu) needs pyscard,
+# so the parsers can be used without a reader or the native library.
+# The reader backends live in rfid, which is only imported when needed.
+
+import os
+import time
+
+
+# Try to use pyscard exceptions so it's easier to catch, but
+# don't need them to be there
+try:
+    from smartcard.Exceptions import SmartcardException
+except ImportError:
+    SmartcardException = Exception
 
 class TagException(SmartcardException):
     pass
 
 
+# Equivalents of the smartcard.util functions we use
+
+def toHexString(bytes):
+    return ' '.join('%02X' % b for b in bytes)
+
+def toASCIIString(bytes):
+    return ''.join(chr(b) if 0x20 <= b < 0x7f else '.' for b in bytes)
+
+def toASCIIBytes(string):
+    return [ord(c) for c in string]
+
+def toBytes(hexstring):
+    hexstring = ''.join(hexstring.split())
+    if len(hexstring) % 2:
+        raise TypeError('not a string representing a list of bytes')
+    return [int(hexstring[i:i + 2], 16) for i in range(0, len(hexstring), 2)]
+
+
+def private_dir(path=None):
+    """
+    A directory only this user can get into, for lock files and the card
+    store. Defaults to rfuid under $XDG_DATA_HOME (or ~/.local/share).
+    """
+    if path is None:
+        base = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+        path = os.path.join(base, 'rfuid')
+
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+    if hasattr(os, 'getuid'):
+        st = os.stat(path)
+        if st.st_uid != os.getuid():
+            raise OSError('%s belongs to another user' % path)
+        if st.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    return path
+
+
+class Deadline(object):
+    """
+    A point in time by which a command (or a whole tap) has to be done.
+
+    Anything that takes a deadline also accepts a number of seconds from now.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+
+    def __repr__(self):
+        return '<Deadline in %.3fs>' % self.remaining()
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    @classmethod
+    def coerce(self, deadline):
+        if deadline is None or isinstance(deadline, Deadline):
+            return deadline
+        return Deadline(deadline)
+
+    @classmethod
+    def earliest(self, *deadlines):
+        deadlines = [d for d in map(self.coerce, deadlines) if d is not None]
+        if not deadlines:
+            return None
+        return min(deadlines, key=lambda d: d.expires)
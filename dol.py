@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Data Object Lists (PDOL, CDOL1, DDOL), which the card sends as a list of
+(tag, length) and expects back as the concatenated values.
+
+A DOL request is compiled once into a byte template with the static
+values already in place, and each transaction just copies that and patches
+the dynamic fields (unpredictable numbers, amount, date and time). Values
+come from PROVIDERS, so new tags only need an entry there (added with
+set_provider, so compiled templates are thrown away). Tags we know
+nothing about get zeros, as EMV Book 3 5.4 says, rather than failing.
+
+No pyscard in here.
+"""
+
+import os
+import time
+import threading
+
+class RandomPool(object):
+    # Buffered urandom, so unpredictable numbers don't cost a syscall each
+    def __init__(self, size=4096):
+        self.size = size
+        self.lock = threading.Lock()
+        self.buffer = b''
+        self.offset = 0
+        self.pid = None
+
+    def read(self, length):
+        with self.lock:
+            # A forked child mustn't hand out the same bytes as its parent
+            if self.offset + length > len(self.buffer) or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.buffer = os.urandom(max(self.size, length))
+                self.offset = 0
+            data = self.buffer[self.offset:self.offset + length]
+            # Never hand out the same bytes twice
+            self.offset += length
+            return data
+
+RANDOM = RandomPool()
+
+def random_bcd(length):
+    # Two random digits a byte. Bytes from 200 up are dropped, so each
+    # of 00-99 is equally likely
+    data = bytearray()
+    while len(data) < length:
+        for b in RANDOM.read(length - len(data)):
+            if b < 200:
+                b %= 100
+                data.append((b // 10) << 4 | b % 10)
+    return data
+
+
+def bcd(value, length):
+    digits = '%0*d' % (length * 2, value)
+    return bytearray.fromhex(digits[-length * 2:])
+
+def fit(value, length, numeric):
+    # EMV Book 3 5.4: numeric values are right-justified with leading
+    # zeros (and lose leading digits if too long), everything else is
+    # padded or truncated on the right
+    value = bytearray(value)
+    if numeric:
+        value = value[len(value) - length:] if len(value) > length else value
+        return bytearray(length - len(value)) + value
+    value = value[:length]
+    return value + bytearray(length - len(value))
+
+
+# Where each tag's value comes from, as (source, DOL attribute, numeric).
+# Static values are read from the DOL when compiling, and the rest are
+# filled in on each transaction.
+STATIC = 'static'
+RANDOM_BYTES = 'random'
+RANDOM_DIGITS = 'random digits'
+AMOUNT = 'amount'
+OTHER_AMOUNT = 'other_amount'
+DATE = 'date'
+TIME = 'time'
+
+PROVIDERS = {
+    0x9f66: (STATIC, 'ttq', False),                 # Terminal transaction qualifiers
+    0x5f2a: (STATIC, 'ccy', True),                  # Transaction currency code
+    0x9f1a: (STATIC, 'country', True),              # Terminal country code
+    0x9c:   (STATIC, 'transaction_type', True),
+    0x95:   (STATIC, 'tvr', False),                 # Terminal verification results
+    0x9f33: (STATIC, 'capabilities', False),        # Terminal capabilities
+    0x9f40: (STATIC, 'additional_capabilities', False),
+    0x9f35: (STATIC, 'terminal_type', True),
+    0x9f34: (STATIC, 'cvm_results', False),
+    0x9f4e: (STATIC, 'merchant_name', False),
+    0x9f02: (AMOUNT, None, True),                   # Amount, authorised
+    0x9f03: (OTHER_AMOUNT, None, True),             # Amount, other
+    0x9a:   (DATE, None, True),                     # YYMMDD
+    0x9f21: (TIME, None, True),                     # HHMMSS
+    0x9f37: (RANDOM_BYTES, None, False),            # Unpredictable number
+    0x9f6a: (RANDOM_DIGITS, None, True),            # Unpredictable number (numeric)
+}
+
+
+class Template(object):
+    def __init__(self, dol_req, data, dynamic):
+        self.dol_req = dol_req
+        # Static values already in place
+        self.data = data
+        # (offset, length, source)
+        self.dynamic = dynamic
+
+    def __repr__(self):
+        return '<Template %s bytes, %s dynamic>' % (len(self.data), len(self.dynamic))
+
+    def render(self, dol, now=None):
+        data = bytearray(self.data)
+        if not self.dynamic:
+            return list(data)
+
+        if now is None:
+            now = time.localtime()
+
+        for offset, length, source in self.dynamic:
+            if source == RANDOM_BYTES:
+                value = RANDOM.read(length)
+            elif source == RANDOM_DIGITS:
+                value = random_bcd(length)
+            elif source == AMOUNT:
+                value = bcd(dol.amount, length)
+            elif source == OTHER_AMOUNT:
+                value = bcd(dol.other_amount, length)
+            elif source == DATE:
+                value = fit(bcd(int(time.strftime('%y%m%d', now)), 3), length, True)
+            elif source == TIME:
+                value = fit(bcd(int(time.strftime('%H%M%S', now)), 3), length, True)
+            data[offset:offset + length] = value
+
+        return list(data)
+
+
+def compile_dol(dol_req, dol, providers=PROVIDERS):
+    """
+    Static values go straight into the template, and the rest are left as
+    zeros for render() to fill in.
+
+    >>> class Terminal(object):
+    ...     ttq = [0xa6, 0x20, 0xc0, 0x00]
+    ...     amount = 150
+    >>> template = compile_dol([(0x9f66, 4), (0x9f02, 6), (0x9f99, 2)], Terminal())
+    >>> template
+    <Template 12 bytes, 1 dynamic>
+    >>> template.dynamic
+    [(4, 6, 'amount')]
+
+    The amount is BCD, and the tag we don't know stays zero.
+
+    >>> template.render(Terminal()) == [0xa6, 0x20, 0xc0, 0, 0, 0, 0, 0, 0x01, 0x50, 0, 0]
+    True
+    """
+    data = bytearray()
+    dynamic = []
+    for tag, length in dol_req:
+        source, attr, numeric = providers.get(tag, (None, None, False))
+        if source == STATIC:
+            data += fit(getattr(dol, attr), length, numeric)
+        else:
+            if source is not None and length:
+                dynamic.append((len(data), length, source))
+            # Unknown tags stay zero
+            data += bytearray(length)
+
+    return Template(tuple(dol_req), data, dynamic)
+
+
+# Compiled templates, shared by every DOL. They're keyed by the request
+# and the static values it uses, so DOLs with different terminal values
+# get their own, and changing a DOL's values just means a new key.
+# STATIC_ATTRS has which DOL attributes each request uses, so building the
+# key doesn't mean going through the request each time
+TEMPLATES = {}
+STATIC_ATTRS = {}
+TEMPLATES_MAX = 256
+TEMPLATES_LOCK = threading.Lock()
+
+def set_provider(tag, source, attr=None, numeric=False):
+    with TEMPLATES_LOCK:
+        PROVIDERS[tag] = source, attr, numeric
+        # Anything compiled before could have the wrong value for it
+        TEMPLATES.clear()
+        STATIC_ATTRS.clear()
+
+def static_attrs(dol_req):
+    attrs = []
+    for tag, length in dol_req:
+        source, attr, numeric = PROVIDERS.get(tag, (None, None, False))
+        if source == STATIC:
+            attrs.append(attr)
+    return tuple(attrs)
+
+def cached_template(dol_req, dol):
+    dol_req = tuple(dol_req)
+    attrs = STATIC_ATTRS.get(dol_req)
+    if attrs is None:
+        attrs = static_attrs(dol_req)
+
+    key = dol_req, tuple(tuple(getattr(dol, attr)) for attr in attrs)
+    template = TEMPLATES.get(key)
+    if template is None:
+        template = compile_dol(dol_req, dol)
+        with TEMPLATES_LOCK:
+            if len(TEMPLATES) >= TEMPLATES_MAX:
+                # Only a handful in practice, so this shouldn't happen
+                TEMPLATES.clear()
+                STATIC_ATTRS.clear()
+            STATIC_ATTRS[dol_req] = attrs
+            TEMPLATES[key] = template
+    return template
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 
-from smartcard.util import toHexString, toASCIIString, toASCIIBytes, toBytes
 from .ber import Tags, BERWithTags
+import threading
 from collections import OrderedDict
-from os import urandom
-from .common import TagException
+from .common import Deadline, TagException, toHexString, toASCIIString, toASCIIBytes, toBytes
+from .apdu import APDU, on_channel
+from .dol import cached_template
 
 class EMVError(TagException):
     pass
@@ -161,6 +162,56 @@ def parse_track2(ber):
     return track2
 
 
+def decode_afl(data):
+    """
+    Application file locator: 4 bytes per entry, which are
+    SFI << 3, first record, last record, and how many records
+    (from the first) take part in offline data authentication
+
+    >>> decode_afl([0x08, 0x01, 0x01, 0x00, 0x10, 0x01, 0x03, 0x01])
+    [(1, 1, 1, 0), (2, 1, 3, 1)]
+
+    >>> try:
+    ...     decode_afl([0x08, 0x02, 0x01, 0x00])
+    ... except EMVError as e:
+    ...     print(e)
+    Invalid AFL entry 08 02 01 00
+    """
+    if len(data) % 4:
+        raise EMVError('AFL length %s is not a multiple of 4' % len(data))
+
+    entries = []
+    for entry in chunk(list(data), 4):
+        sfi, first, last, auth = entry
+        sfi >>= 3
+        if not 1 <= sfi <= 30 or not first or last < first or auth > last - first + 1:
+            raise EMVError('Invalid AFL entry %s' % toHexString(entry))
+        entries.append((sfi, first, last, auth))
+
+    return entries
+
+def parse_afl(ber):
+    return decode_afl(ber.data)
+
+def afl_records(afl):
+    # (sfi, record, offline_auth) for every record listed, in order
+    for sfi, first, last, auth in afl:
+        for record in range(first, last + 1):
+            yield sfi, record, record < first + auth
+
+# These change on every transaction, so don't identify a GPO response
+UNPREDICTABLE_TAGS = [0x9f37, 0x9f6a, 0x9a, 0x9f21]
+
+def dol_key(dol_req, dol):
+    # The DOL data, with unpredictable numbers zeroed
+    key = []
+    for tag, length in dol_req or []:
+        data = dol[len(key):len(key) + length]
+        if tag in UNPREDICTABLE_TAGS:
+            data = [0] * length
+        key += data
+    return key
+
 def format_dfname(ber):
     if ber.data[0] & 0x80:
         return toHexString(ber.data)
@@ -207,6 +258,21 @@ class EMV(object):
         0x6f: 'Unknown',
     }
 
+    # Commands after which the card isn't as a fresh SELECT would leave it
+    STATE_CHANGING = {
+        0xa4: 'SELECT',
+        0xa8: 'GET PROCESSING OPTIONS',
+        0xae: 'GENERATE AC',
+        0x20: 'VERIFY',
+        0x82: 'EXTERNAL AUTHENTICATE',
+    }
+    # Errors which don't change the card's state
+    HARMLESS_ERRORS = [
+        (0x6a, 0x82),  # file not found
+        (0x6a, 0x83),  # record not found
+        (0x6a, 0x88),  # data not found
+    ]
+
     TAGS = Tags(
         (0x4f,   'AID', raw),
         (0x50,   'APP_LABEL', str),
@@ -222,9 +288,11 @@ class EMV(object):
         (0x82,   'AIP', raw),  # Application interchange profile
         (0x84,   'DFNAME'),  # FIXME: create a DFName object
         (0x87,   'PRIORITY', int),
+        (0x8c,   'CDOL1', tag_length),
+        (0x8d,   'CDOL2', tag_length),
         (0x88,   'SFI', int),
         (0x90,   'OK'),
-        (0x94,   'AFL', raw),  # Application file locator
+        (0x94,   'AFL', parse_afl),  # Application file locator
         (0xa5,   'FCI_ISSUER'),
         (0x9f10, 'IAD', raw),  # Issuer application data
         (0x9f26, 'AC', raw),  # Application cryptogram
@@ -251,17 +319,62 @@ class EMV(object):
 
     BER = BERWithTags(TAGS)
 
-    def __init__(self, tag):
+    def __init__(self, tag, channel=0):
         self.tag = tag
+        # Logical channel, encoded in the CLA of everything we send (see Tag.app)
+        self.channel = channel
         self.pin_tries = None
+        # See use_store
+        self.store = None
+        self.card = None
+        # DF name of the selected application
+        self.aid = None
+        # A GPO answered from the store, which the card hasn't seen yet
+        self.pending_gpo = None
+        # SELECTs answered from Tag.selections
+        self.selects_skipped = 0
+        # Which GET DATA tags we know this sort of card answers
+        self.capabilities = CAPABILITIES
+
+    def use_store(self, store, *card):
+        """
+        Keep static responses in a CardStore, so later reads can skip them.
+
+        card is whatever identifies the card (e.g. the UID, if it's not
+        randomised). It's only kept as a keyed hash.
+        """
+        self.store = store
+        self.card = store.card_key(*card)
+
+    def stored(self, kind, key, fetch, keep=None):
+        # fetch() sends the real command, if the store doesn't have it.
+        # Responses keep() says no to are used, but not stored
+        if self.store is None:
+            return fetch()
+
+        key = '%s:%s' % (toHexString(self.aid or []), key)
+        resp = self.store.get(self.card, kind, key)
+        if resp is None:
+            resp = fetch()
+            if keep is None or keep(resp):
+                self.store.put(self.card, kind, key, resp)
+        return resp
 
-    def send(self, apdu):
-        resp = self.tag.send(apdu)
+    def send(self, apdu, deadline=None):
+        if self.channel:
+            apdu = on_channel(apdu, self.channel)
+
+        # Tag.send keeps track of what this does to the selection
+        resp = self.tag.send(apdu, deadline=deadline)
         sw1, sw2 = resp[-2:]
         if (sw1, sw2) == (0x90, 0):
             return resp
         raise EMVException(sw1, sw2)
 
+    def invalidate(self):
+        # The next SELECT on this channel has to go to the card
+        self.tag.selections.pop(self.channel, None)
+
     def select_by_id(self, type=0, id=None):
         # Doesn't seem to work
         if id is None:
@@ -270,13 +383,25 @@ class EMV(object):
         return resp
 
     def select_by_df(self, pattern, which='first'):
-        which = ['first', 'last', 'next', 'prev'].index(which)
-        resp = self.send(APDU(0, 0xa4, 4, which, data=pattern))
+        selection = self.tag.selections.get(self.channel)
+        skipped = which == 'first' and selection is not None and selection[0] == tuple(pattern)
+        if skipped:
+            # Selecting it again wouldn't change anything
+            self.selects_skipped += 1
+            resp = selection[1]
+        else:
+            which = ['first', 'last', 'next', 'prev'].index(which)
+            resp = self.send(APDU(0, 0xa4, 4, which, data=pattern))
+            if which == 0:
+                self.tag.selections[self.channel] = tuple(pattern), resp
+        self.pending_gpo = None
 
         ber = self.BER(resp)
         fci = ber['FCI']
         fci_issuer = fci['FCI_ISSUER']
 
+        self.aid = fci['DFNAME'].data
+
         # FIXME: this should be a class or dict
         df = format_dfname(fci['DFNAME'])
         sfi = fci_issuer.getparsed('SFI')
@@ -296,19 +421,62 @@ class EMV(object):
 
         return dfs
 
+    def find_apps(self, discovery=None):
+        # PPSE, then partial AIDs (see aids.py)
+        if discovery is None:
+            discovery = aids.discovery
+        return discovery.apps(self)
+
     def read_record(self, record, sfi=None, which='index'):
         if sfi is None:
             sfi = 0
         which = ['first', 'last', 'next', 'prev', 'index', 'indexfrom', 'indexto'].index(which)
-        resp = self.send(APDU(0, 0xb2, record, (sfi << 3) + which))
-        return resp
+        apdu = APDU(0, 0xb2, record, (sfi << 3) + which)
+        if which != 4:
+            return self.send(apdu)
+
+        def fetch():
+            if self.pending_gpo is not None:
+                # Records may not be readable until the card's done GPO
+                self.send(self.pending_gpo)
+                self.pending_gpo = None
+            return self.send(apdu)
+
+        return self.stored('record', '%s.%s' % (sfi, record), fetch)
 
     def read_record_parsed(self, record, sfi=None, which='index'):
         data = self.read_record(record, sfi=sfi, which=which)
         ber = self.BER(data)
         return ber['EMV']
 
+    def read_records(self, afl):
+        """
+        Read exactly the records listed in the AFL, yielding
+        (sfi, record, offline_auth, raw, data) as each one arrives.
+
+        For offline data authentication, records from SFIs 1-10 contribute
+        the value of their 70 template, and those from SFIs 11-30 the whole
+        record (EMV Book 3, 10.3), which is raw (without the status).
+        data is the parsed 70 template. SFIs 1-10 have to have one, but
+        records from SFIs 11-30 can be anything, so data may be None.
+        """
+        for sfi, record, auth in afl_records(afl):
+            raw = self.read_record(record, sfi)[:-2]
+            try:
+                ber = self.BER(raw)
+                data = ber['EMV'] if 'EMV' in ber else None
+            except (ValueError, IndexError, EOFError):
+                data = None
+
+            if data is None and sfi <= 10:
+                raise EMVError('SFI %s record %s is not a 70 template' % (sfi, record))
+            yield sfi, record, auth, raw, data
+
+    def read_afl_records(self, afl):
+        return list(self.read_records(afl))
+
     def read_all_records(self, sfi):
+        # Without an AFL, read until the card says there are no more
         records = []
         for n in range(1, 0x7f):
             try:
@@ -351,13 +519,47 @@ class EMV(object):
         resp = self.send(APDU(0, 0x84, data=[0] * length))
         return self.BER(resp)
 
-    def get_data(self, tag):
+    def get_data(self, tag, deadline=None):
         if isinstance(tag, str):
             tag = self.TAGS[tag]
         # Seems to work with either 0 or 0x80 for class
-        resp = self.send(APDU(0x80, 0xca, tag >> 8, tag & 0xff))
+        resp = self.send(APDU(0x80, 0xca, tag >> 8, tag & 0xff), deadline=deadline)
         return resp
 
+    # What cards say when they don't have a tag
+    NO_DATA = [(0x6a, 0x88), (0x6a, 0x81)]
+
+    def get_data_many(self, tags, deadline=None):
+        """
+        GET DATA for several tags, returning {tag: parsed value} for
+        the ones the card has.
+
+        Tags the selected application is known not to have are skipped,
+        and what we learn goes into self.capabilities for next time.
+        Commands go back to back under one deadline, and are parsed
+        once they're all done.
+        """
+        deadline = Deadline.coerce(deadline)
+
+        responses = []
+        for tag in tags:
+            num = self.TAGS[tag] if isinstance(tag, str) else tag
+            if self.capabilities.supported(self, num) is False:
+                continue
+
+            try:
+                responses.append((tag, num, self.get_data(num, deadline=deadline)))
+            except EMVException as e:
+                if (e.sw1, e.sw2) not in self.NO_DATA:
+                    raise
+                self.capabilities.learn(self, num, False)
+
+        values = {}
+        for tag, num, resp in responses:
+            self.capabilities.learn(self, num, True)
+            values[tag] = self.BER(resp).parsed(num)
+        return values
+
     def get_data_parsed(self, tag):
         data = self.get_data(tag)
         ber = self.BER(data)
@@ -374,16 +576,45 @@ class EMV(object):
             dol = DOL()
         pdol = dol.get_dol(pdol_req)
         # FIXME: make the dol have a todata function which returns 0x83...
-        resp = self.send(APDU(0x80, 0xa8, data=[0x83, len(pdol)] + pdol))
+        apdu = APDU(0x80, 0xa8, data=[0x83, len(pdol)] + pdol)
+
+        fetched = []
+        def fetch():
+            fetched.append(True)
+            return self.send(apdu)
+
+        resp = self.stored('gpo', toHexString(dol_key(pdol_req, pdol)), fetch, self.static_options)
+        if not fetched:
+            # Saves incrementing the ATC, unless we need to read a record after all
+            self.pending_gpo = apdu
         return self.BER(resp)
 
-    def generate_ac(self, type='aac'):
-        #, cdol_req, data):
+    # Format 2 GPO responses can carry a cryptogram for this transaction
+    DYNAMIC_OPTIONS = ['AC', 'ATC', 'SDAD']
+
+    def static_options(self, resp):
+        options = self.BER(resp)
+        if 'RMTF2' not in options:
+            return True
+        rmtf2 = options['RMTF2']
+        return not any(name in rmtf2 for name in self.DYNAMIC_OPTIONS)
+
+    def parse_options(self, options):
+        # GPO response: AIP and AFL, in either format 1 or format 2
+        if 'RMTF1' in options:
+            data = options.parsed('RMTF1')
+            return data[:2], decode_afl(data[2:])
+
+        rmtf2 = options['RMTF2']
+        return rmtf2.parsed('AIP'), rmtf2.getparsed('AFL', [])
+
+    def generate_ac(self, type='aac', cdol_req=None, dol=None):
         # priority order is tc (transaction certificate), arqc (auth req), aac (app authentication - declined), aar
+        # cdol_req is the CDOL1 from the records, parsed
         p1 = ['aac', 'tc', 'arqc', 'aar'].index(type) * 0x40
-        #cdol_req = [(0x9f6a, 0x04)]
-        #cdol = self.create_dol(cdol_req)
-        #cdol = [0, 0, 0, 0, 1, 0] + [0, 0, 0, 0, 0, 0] + [0x8, 0x26] + [0, 0, 0, 0] + [0x8, 0x26] + [0x10, 0x10, 0x10] + [0] + [0x12, 0x34, 0x56, 0x78]
+        if dol is None:
+            dol = DOL()
+        cdol = dol.get_dol(cdol_req)
         resp = self.send(APDU(0x80, 0xae, p1, data=cdol))
         return self.BER(resp)
 
@@ -391,15 +622,100 @@ class EMV(object):
         resp = self.send(APDU(0, 0x82))
         return self.BER(resp)
 
+class Capabilities(object):
+    """
+    Which GET DATA tags each application answers, by card family (SEL_RES
+    and ATS) and AID. brute_data.py-style probing only needs doing once.
+
+    Give it a CardStore to keep what's learnt between sessions and share
+    it between processes.
+    """
+    def __init__(self, store=None):
+        self.store = store
+        self.lock = threading.Lock()
+        # (family, AID) -> {tag: supported}
+        self.known = {}
+
+    def key(self, emv):
+        tag = emv.tag
+        family = getattr(tag, 'sel_res', None), tuple(getattr(tag, 'ats', None) or [])
+        return family, tuple(emv.aid or [])
+
+    def store_key(self, key):
+        (sel_res, ats), aid = key
+        return self.store.card_key('capabilities', '%s' % sel_res, list(ats), list(aid))
+
+    def supported(self, emv, tag):
+        # True, False, or None if we don't know yet
+        key = self.key(emv)
+        with self.lock:
+            supported = self.known.get(key, {}).get(tag)
+        if supported is not None or self.store is None:
+            return supported
+
+        stored = self.store.get(self.store_key(key), 'getdata', '%04x' % tag)
+        if stored is None:
+            return None
+
+        supported = bool(stored[0])
+        with self.lock:
+            self.known.setdefault(key, {})[tag] = supported
+        return supported
+
+    def learn(self, emv, tag, supported):
+        key = self.key(emv)
+        with self.lock:
+            tags = self.known.setdefault(key, {})
+            if tags.get(tag) == supported:
+                return
+            tags[tag] = supported
+
+        if self.store is not None:
+            self.store.put(self.store_key(key), 'getdata', '%04x' % tag, [int(supported)])
+
+CAPABILITIES = Capabilities()
+
+
 # Data Object List
 class DOL(object):
-    def __init__(self, ttq=None, ccy=None):
+    """
+    Terminal values for answering a PDOL or CDOL (see dol.py).
+
+    Requests are compiled to a template the first time we see them, which
+    is once per AID profile in practice, and then only the dynamic fields
+    are filled in for each transaction. Templates are shared between DOLs
+    with the same static values (see dol.cached_template), so creating a
+    new DOL each time costs nothing extra.
+    """
+    def __init__(self, ttq=None, ccy=None, amount=0, other_amount=0):
+        # TTQ - terminal transaction qualifier
+        # Byte 1
+        # +0x80 MSD (magstripe mode) contactless supported
+        #  0x40 VSDC contactless supported (reserved in EMV)
+        # +0x20 qVSDC (EMV mode) contactless supported
+        # +0x10 VSDC (EMV) contact chip supported
+        # +0x08 no online mode supported
+        # +0x04 online PIN supported
+        # +0x02 signature supported
+        # +0x01 offline DA for online supported
+        #
+        # Byte 2
+        # +0x80 online cryptogram required
+        # +0x40 CVM required
+        # +0x20 contact chip offline PIN supported
+        #
+        # Byte 3
+        # +0x80 issuer update processing
+        # +0x40 consumer device CVM
+        #
+        # All else reserved
         self.ttq = [0x80 | 0x08 | 0x02, 0, 0, 0]
         self.ttq = [0x80 | 0x40 | 0x20 | 0x10 | 0x04 | 0x02, 0, 0, 0]
         self.ttq = [0xa6, 0x20, 0xc0, 0]
         if ttq is not None:
             self.ttq = ttq
 
+        # Country code - http://en.wikipedia.org/wiki/ISO_4217
         self.ccy = [0x08, 0x26] # GBP
         self.ccy = [0x08, 0x40] # USD
         self.ccy = [0x09, 0x63] # Testing
@@ -409,77 +725,46 @@ class DOL(object):
         if ccy is not None:
             self.ccy = ccy
 
-    def get_dol(self, dol_req=None):
-        dol = []
-        if dol_req is None:
-            dol_req = []
-
-        # a6 20 c0 00
-        # 00 00 00 00 00 01 
-        # 55 5d 77 41
-        # 09 78
-        for tag, length in dol_req:
-            if (tag, length) == (0x9f66, 4):
-                # TTQ - terminal transaction qualifier
-                # Byte 1
-                # +0x80 MSD (magstripe mode) contactless supported
-                #  0x40 VSDC contactless supported (reserved in EMV)
-                # +0x20 qVSDC (EMV mode) contactless supported
-                # +0x10 VSDC (EMV) contact chip supported
-                # +0x08 no online mode supported
-                # +0x04 online PIN supported
-                # +0x02 signature supported
-                # +0x01 offline DA for online supported
-                #
-                # Byte 2
-                # +0x80 online cryptogram required
-                # +0x40 CVM required
-                # +0x20 contact chip offline PIN supported
-                #
-                # Byte 3
-                # +0x80 issuer update processing
-                # +0x40 consumer device CVM
-                #
-                # All else reserved
-
-                data = self.ttq
-
-            elif (tag, length) == (0x9f02, 6):
-                # Amount authorised
-                data = [0, 0, 0, 0, 0, 0]
-
-            elif tag == 0x9f37:
-                # Unpredictable number
-                data = list(map(ord, urandom(length)))
-
-            elif tag == 0x9f6a:
-                # Unpredictable number
-                data = list(map(ord, urandom(length)))
-
-            elif (tag, length) == (0x5f2a, 2):
-                # Country code - http://en.wikipedia.org/wiki/ISO_4217
-                data = self.ccy
+        self.country = [0x08, 0x26]
+        self.transaction_type = [0x00]  # Purchase
+        self.tvr = [0, 0, 0, 0, 0]
+        self.capabilities = [0xe0, 0x08, 0x08]
+        self.additional_capabilities = [0, 0, 0, 0, 0]
+        self.terminal_type = [0x22]  # Attended, offline with online capability
+        self.cvm_results = [0x3f, 0, 0]  # No CVM performed
+        self.merchant_name = []
+        self.amount = amount
+        self.other_amount = other_amount
 
-            else:
-                raise NotImplementedError('Cannot reply to PDOL tag %s with length %s' % (tag, length))
-
-            assert len(data) == length
-            dol += data
+    def template(self, dol_req):
+        return cached_template(dol_req, self)
 
-        return dol
+    def get_dol(self, dol_req=None):
+        if not dol_req:
+            return []
+        return self.template(dol_req).render(self)
 
 
+from . import aids
 
 if __name__ == '__main__':
     from .rfid import Pcsc, AcsReader
+    from .store import CardStore
     from pprint import pprint
     import sys
 
+    store = CardStore()
+
     with Pcsc.reader() as reader:
         for tag in reader.tags:
 
             # print tag.find_unique_id()
 
+            # Randomised UIDs (08 then three random bytes, ISO14443-3 6.4.4)
+            # and fixed ones like 21222324 can't tell cards apart
+            if tag.uid != '21222324' and not (len(tag.uid) == 8 and tag.uid.startswith('08')):
+                tag.emv.use_store(store, tag.uid)
+
 
             # Why does 2PAY return an empty sfi?
 
@@ -509,7 +794,7 @@ if __name__ == '__main__':
                 apps = data.getlistparsed('APP')
 
             else:
-                apps = [(0, 'BARCLAYS', [0xa0, 0x00, 0x00, 0x00, 0x03, 0x80, 0x02])]  # Visa CAP
+                apps = tag.emv.find_apps()
 
 
             for priority, name, aid in apps:
@@ -547,24 +832,13 @@ if __name__ == '__main__':
 
                 if True:
                     #print tag.emv.get_data_parsed('ATC')
-                    # This increments the ATC
+                    # This increments the ATC, unless the store has it from last time
                     options = tag.emv.get_options(pdol_req)
-                    # TODO: save this for next time so we don't need to increment ATC
                     #print tag.emv.get_data_parsed('ATC')
 
-                    if 'RMTF1' in options:
-                        options['RMTF1'].dump()
-                        aip = options['RMTF1'].data[:2]
-                        afl = options['RMTF1'].data[2:]
-                        print('AIP: %s' % aip)
-                        print('AFL: %s' % afl)
-
-                        sfi = afl[0] >> 3
-                        start, end, authrecords = afl[1:]
-
-                    elif 'RMTF2' in options:
-                        sfi, start, end, authrecords = options['RMTF2']['AFL'].data
-                        aip = options['RMTF2']['AIP'].data
+                    aip, afl = tag.emv.parse_options(options)
+                    print('AIP: %s' % aip)
+                    print('AFL: %s' % afl)
 
                     # FIXME
                     AIP_BYTE1 = [
@@ -581,7 +855,7 @@ if __name__ == '__main__':
                     ]
 
                 else:
-                    sfi, start, end, authrecords = 1, 1, 1, 0
+                    afl = [(1, 1, 1, 0)]
 
                 if False:
                     for i in range(0x40):
@@ -593,13 +867,17 @@ if __name__ == '__main__':
                     else:
                         print('No challenge length accepted')
 
-                if authrecords > 0:
-                    # follow process at http://www.openscdp.org/scripts/tutorial/emv/readapplicationdata.html
-                    raise NotImplementedError()
+                for sfi, record, auth, raw, data in tag.emv.read_records(afl):
+                    # auth records go into offline data authentication, see
+                    # http://www.openscdp.org/scripts/tutorial/emv/readapplicationdata.html
+                    print('SFI %s record %s%s:' % (sfi, record, ' (offline auth)' if auth else ''))
+                    if data is None:
+                        print(toHexString(raw))
+                        continue
+                    data.dump()
+                    if 'TRACK2' not in data:
+                        continue
 
-                for i in range(start, end + 1):
-                    data = tag.emv.read_record_parsed(i, sfi)
-                    print(data.dump())
                     extra = data.parsed('TRACK2')['extra']
                     assert extra[-1:] == 'F'  # padding
                     assert extra[-2:-1] == '1'  # ? is 0 for just-EMV mode
@@ -623,6 +901,3 @@ if __name__ == '__main__':
                 cid = 0 # 5.4.3.1
 
                 break # temporarily
-
-
-from .rfid import AcsReader, APDU
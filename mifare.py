@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Memory access for Mifare Ultralight and Classic tags, which don't speak ISO7816.
+
+Commands go through the PN532 (InDataExchange, or InCommunicateThru for
+commands the PN532 doesn't know about), and are batched to keep the number
+of RF frames down for a whole-card dump.
+
+Sources:
+http://www.nxp.com/documents/data_sheet/MF0ICU1.pdf
+http://www.nxp.com/documents/data_sheet/MF0ULX1.pdf
+http://www.nxp.com/documents/data_sheet/NTAG213_215_216.pdf
+http://www.nxp.com/documents/data_sheet/MF1S503x.pdf
+"""
+
+from .common import TagException
+
+class MifareException(TagException):
+    pass
+
+
+class Ultralight(object):
+    READ = 0x30
+    FAST_READ = 0x3a
+    GET_VERSION = 0x60
+
+    # Storage size byte from GET_VERSION, to number of pages
+    SIZES = {
+        0x0b: 20,   # Ultralight EV1 MF0UL11
+        0x0e: 41,   # Ultralight EV1 MF0UL21
+        0x0f: 45,   # NTAG213
+        0x11: 135,  # NTAG215
+        0x13: 231,  # NTAG216
+    }
+    # The original Ultralight doesn't support GET_VERSION
+    DEFAULT_PAGES = 16
+    PAGE_SIZE = 4
+    # Keep FAST_READ responses within one PN532 frame
+    FAST_READ_PAGES = 60
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.version = None
+        self.pages = None
+
+    def get_version(self):
+        if self.pages is not None:
+            return self.version
+
+        try:
+            self.version = self.tag.reader.communicate_thru(self.tag.id, [self.GET_VERSION])
+        except TagException:
+            # The tag NAKs and goes back to idle, so wake it up again
+            self.version = None
+            self.tag.select()
+
+        if self.version and len(self.version) == 8:
+            self.pages = self.SIZES.get(self.version[6], self.DEFAULT_PAGES)
+        else:
+            self.pages = self.DEFAULT_PAGES
+        return self.version
+
+    def reset(self):
+        # Nothing to forget, as the version doesn't change
+        pass
+
+    def read(self, page):
+        # Always returns 4 pages, wrapping round at the end
+        resp = self.tag.send([self.READ, page])
+        if len(resp) != 4 * self.PAGE_SIZE:
+            raise MifareException('Unexpected READ response length %s' % len(resp))
+        return resp
+
+    def fast_read(self, start, end):
+        resp = self.tag.reader.communicate_thru(self.tag.id, [self.FAST_READ, start, end])
+        if len(resp) != (end - start + 1) * self.PAGE_SIZE:
+            raise MifareException('Unexpected FAST_READ response length %s' % len(resp))
+        return resp
+
+    def read_pages(self, start, count):
+        self.get_version()
+        count = min(count, self.pages - start)
+
+        data = []
+        if self.version:
+            # EV1 and NTAG can read any range in one go
+            for first in range(start, start + count, self.FAST_READ_PAGES):
+                last = min(first + self.FAST_READ_PAGES, start + count) - 1
+                data += self.fast_read(first, last)
+        else:
+            for page in range(start, start + count, 4):
+                data += self.read(page)
+            data = data[:count * self.PAGE_SIZE]
+
+        return data
+
+    def dump(self):
+        self.get_version()
+        data = self.read_pages(0, self.pages)
+        return [data[i:i + self.PAGE_SIZE] for i in range(0, len(data), self.PAGE_SIZE)]
+
+
+class Classic(object):
+    AUTH_A = 0x60
+    AUTH_B = 0x61
+    READ = 0x30
+    BLOCK_SIZE = 16
+
+    # Well-known keys, tried in order after any we've already seen work
+    KEYS = [
+        [0xff, 0xff, 0xff, 0xff, 0xff, 0xff],  # Factory default
+        [0xa0, 0xa1, 0xa2, 0xa3, 0xa4, 0xa5],  # MAD
+        [0xd3, 0xf7, 0xd3, 0xf7, 0xd3, 0xf7],  # NDEF
+        [0x00, 0x00, 0x00, 0x00, 0x00, 0x00],
+    ]
+
+    # Keys that worked, by (UID, sector), shared between taps
+    known_keys = {}
+
+    def __init__(self, tag, sectors=16):
+        self.tag = tag
+        self.sectors = sectors
+        self.authenticated = None
+        self.keys = list(self.KEYS)
+
+    def reset(self):
+        # Reactivating the card drops any authentication
+        self.authenticated = None
+
+    def blocks_in_sector(self, sector):
+        # 4k cards have 32 sectors of 4 blocks, then 8 of 16
+        return 4 if sector < 32 else 16
+
+    def first_block(self, sector):
+        if sector < 32:
+            return sector * 4
+        return 128 + (sector - 32) * 16
+
+    def uid(self):
+        # Authentication uses the last 4 bytes
+        uid = [int(self.tag.uid[i:i + 2], 16) for i in range(0, len(self.tag.uid), 2)]
+        return uid[-4:]
+
+    def authenticate(self, sector, key_type, key):
+        block = self.first_block(sector)
+        cmd = self.AUTH_A if key_type == 'A' else self.AUTH_B
+        try:
+            self.tag.send([cmd, block] + list(key) + self.uid())
+        except TagException:
+            # A failed authentication halts the card
+            self.authenticated = None
+            self.tag.select()
+            return False
+
+        self.authenticated = sector
+        return True
+
+    def candidate_keys(self, sector):
+        known = self.known_keys.get((self.tag.uid, sector))
+        if known is not None:
+            yield known
+        for key in self.keys:
+            for key_type in 'AB':
+                if (key_type, key) != known:
+                    yield key_type, key
+
+    def unlock(self, sector):
+        if self.authenticated == sector:
+            return True
+
+        for key_type, key in self.candidate_keys(sector):
+            if self.authenticate(sector, key_type, key):
+                self.known_keys[(self.tag.uid, sector)] = key_type, key
+                return True
+
+        return False
+
+    def read_block(self, block):
+        resp = self.tag.send([self.READ, block])
+        if len(resp) != self.BLOCK_SIZE:
+            raise MifareException('Unexpected READ response length %s' % len(resp))
+        return resp
+
+    def read_sector(self, sector):
+        if not self.unlock(sector):
+            raise MifareException('No key found for sector %s' % sector)
+
+        first = self.first_block(sector)
+        return [self.read_block(block) for block in range(first, first + self.blocks_in_sector(sector))]
+
+    def dump(self):
+        # Sectors we can't authenticate to come back as None
+        sectors = []
+        for sector in range(self.sectors):
+            try:
+                sectors.append(self.read_sector(sector))
+            except MifareException:
+                sectors.append(None)
+        return sectors
+
+
+def for_tag(tag):
+    if tag.sel_res == 0x00:
+        return Ultralight(tag)
+    if tag.sel_res == 0x08:
+        return Classic(tag, sectors=16)
+    if tag.sel_res == 0x09:
+        return Classic(tag, sectors=5)
+    if tag.sel_res == 0x18:
+        return Classic(tag, sectors=40)
+    return None
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Card profiles, so repeat taps from the same family of card only send the
+commands that actually identify it.
+
+The first tap of a family does full discovery through a Recorder, which
+notes every command and response. The profile keeps the identifying
+command (the last one sent) and the SELECT it depends on, along with a
+hash of the FCI that SELECT returned. Later taps from the same family
+(same SEL_RES and ATS) replay just those commands. If the FCI differs,
+or anything fails, the profile is dropped and we go back to full discovery.
+
+No pyscard in here.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from .common import TagException
+
+class ProfileMismatch(TagException):
+    pass
+
+
+def digest(resp):
+    return hashlib.sha1(bytes(bytearray(resp))).hexdigest()
+
+def status_ok(resp):
+    return list(resp[-2:]) == [0x90, 0]
+
+
+class Recorder(object):
+    """
+    Notes everything sent to a tag (through Tag.send, whoever sends it)
+    and what comes back, for as long as it's in use:
+
+        with Recorder(tag) as recorder:
+            tag.emv.get_data('UN')
+        recorder.exchanges
+    """
+    def __init__(self, tag):
+        self.tag = tag
+        self.exchanges = []
+
+    def record(self, apdu, resp):
+        self.exchanges.append((list(apdu), list(resp)))
+
+    def __enter__(self):
+        self.tag.recorders.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tag.recorders.remove(self)
+
+
+class Profile(object):
+    SELECT = 0xa4
+
+    def __init__(self, fingerprint, steps):
+        self.fingerprint = fingerprint
+        # (apdu, FCI hash), with None for the identifying command
+        self.steps = steps
+        self.hits = 0
+
+    def __repr__(self):
+        return '<Profile %s: %s commands>' % (self.fingerprint, len(self.steps))
+
+    @classmethod
+    def learn(self, fingerprint, exchanges):
+        if not exchanges:
+            return None
+
+        apdu, resp = exchanges[-1]
+        if not status_ok(resp):
+            return None
+        steps = [(apdu, None)]
+
+        # The identifying command runs in whatever application was selected last
+        for apdu, resp in reversed(exchanges[:-1]):
+            if apdu[1] == self.SELECT and status_ok(resp):
+                steps.insert(0, (apdu, digest(resp)))
+                break
+
+        # Which application that was isn't part of the fingerprint, as we
+        # can't know it before sending anything. The FCI check on replay
+        # catches cards of the family that select something else.
+        return Profile(fingerprint, steps)
+
+    def replay(self, tag, deadline=None):
+        # Returns the identifying command's response
+        for apdu, expected in self.steps:
+            resp = tag.send(apdu, deadline=deadline)
+            if expected is not None and digest(resp) != expected:
+                raise ProfileMismatch('Response to %s differs from profile' % apdu[:4])
+
+        if not status_ok(resp):
+            raise ProfileMismatch('Identifying command failed: %02x%02x' % tuple(resp[-2:]))
+        return resp
+
+
+class ProfileCache(object):
+    """
+    Profiles by card family, shared by all readers in the process.
+
+    identify(tag, discover, extract) runs discover() on the first tap of a
+    family, noting what it sends to the tag. discover should finish with
+    the command that produces the identifying data. On later taps,
+    extract(resp) is called with the replayed response to that command
+    instead. Either returns None if the card couldn't be identified, and
+    nothing is learnt from that.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.lock = threading.Lock()
+        self.profiles = OrderedDict()
+        self.replays = 0
+        self.discoveries = 0
+        self.mismatches = 0
+
+    def fingerprint(self, tag):
+        # What we know before sending anything (ATS includes the historical bytes)
+        return tag.sel_res, tuple(tag.ats or [])
+
+    def get(self, key):
+        with self.lock:
+            profile = self.profiles.get(key)
+            if profile is not None:
+                self.profiles.move_to_end(key)
+            return profile
+
+    def put(self, key, profile):
+        with self.lock:
+            self.profiles[key] = profile
+            self.profiles.move_to_end(key)
+            while len(self.profiles) > self.size:
+                self.profiles.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.profiles.pop(key, None)
+
+    def identify(self, tag, discover, extract, deadline=None):
+        key = self.fingerprint(tag)
+
+        profile = self.get(key)
+        if profile is not None:
+            try:
+                result = extract(profile.replay(tag, deadline=deadline))
+            except TagException:
+                result = None
+
+            if result is not None:
+                profile.hits += 1
+                self.replays += 1
+                return result
+
+            # Not the sort of card we thought, so find out properly
+            self.mismatches += 1
+            self.discard(key)
+
+        with Recorder(tag) as recorder:
+            result = discover()
+        self.discoveries += 1
+
+        if result is not None:
+            profile = Profile.learn(key, recorder.exchanges)
+            if profile is not None:
+                self.put(key, profile)
+        return result
+
+    def stats(self):
+        return dict(
+            profiles = len(self.profiles),
+            replays = self.replays,
+            discoveries = self.discoveries,
+            mismatches = self.mismatches,
+        )
+
+
+# Used by Tag.find_unique_id unless it's given another
+cache = ProfileCache()
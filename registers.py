@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+PN532 register map, for ReadRegister/WriteRegister.
+
+Registers can be referred to by address, by name ('RFCfg'), or by
+field ('RFCfg.RxGain'). No pyscard in here.
+
+Sources:
+http://www.nxp.com/documents/user_manual/141520.pdf (section 8.6, CIU registers)
+http://www.nxp.com/documents/data_sheet/PN512.pdf (register bit layouts)
+"""
+
+class Register(object):
+    def __init__(self, address, name, fields=None):
+        self.address = address
+        self.name = name
+        # name -> (shift, width)
+        self.fields = {}
+        for field, shift, width in fields or []:
+            self.fields[field] = (shift, width)
+
+    def __repr__(self):
+        return '<Register %s (0x%04x)>' % (self.name, self.address)
+
+    def mask(self, field):
+        shift, width = self.fields[field]
+        return ((1 << width) - 1) << shift
+
+    def get(self, value, field):
+        shift, width = self.fields[field]
+        return (value >> shift) & ((1 << width) - 1)
+
+    def set(self, value, field, fieldvalue):
+        shift, width = self.fields[field]
+        if fieldvalue >> width:
+            raise ValueError('%s.%s is only %s bits' % (self.name, field, width))
+        return (value & ~self.mask(field)) | (fieldvalue << shift)
+
+    def decode(self, value):
+        return dict((field, self.get(value, field)) for field in self.fields)
+
+
+class RegisterMap(object):
+    def __init__(self, *registers):
+        self.registers = registers
+        self.names = {}
+        self.addresses = {}
+        for register in registers:
+            self.names[register.name] = register
+            self.addresses[register.address] = register
+
+    def __getitem__(self, name):
+        return self.names[name]
+
+    def resolve(self, key):
+        # Returns the address and the field (if any) for key
+        if isinstance(key, int):
+            return key, None
+
+        name, _, field = key.partition('.')
+        register = self.names[name]
+        if field and field not in register.fields:
+            raise KeyError('%s has no field %s' % (name, field))
+        return register.address, field or None
+
+    def address(self, key):
+        return self.resolve(key)[0]
+
+    def register(self, address):
+        # For addresses we don't have names for, give back a bare Register
+        register = self.addresses.get(address)
+        if register is None:
+            register = Register(address, '0x%04x' % address)
+        return register
+
+
+REGISTERS = RegisterMap(
+    # CIU, which does the analogue and framing work
+    Register(0x6301, 'Mode', [('MSBFirst', 7, 1), ('TxWaitRF', 5, 1), ('PolSigin', 3, 1), ('CRCPreset', 0, 2)]),
+    Register(0x6302, 'TxMode', [('TxCRCEn', 7, 1), ('TxSpeed', 4, 3), ('InvMod', 3, 1), ('TxMix', 2, 1), ('TxFraming', 0, 2)]),
+    Register(0x6303, 'RxMode', [('RxCRCEn', 7, 1), ('RxSpeed', 4, 3), ('RxNoErr', 3, 1), ('RxMultiple', 2, 1), ('RxFraming', 0, 2)]),
+    Register(0x6304, 'TxControl', [('InvTx2RFOn', 7, 1), ('InvTx1RFOn', 6, 1), ('InvTx2RFOff', 5, 1), ('InvTx1RFOff', 4, 1),
+                                   ('Tx2CW', 3, 1), ('CheckRF', 2, 1), ('Tx2RFEn', 1, 1), ('Tx1RFEn', 0, 1)]),
+    Register(0x6305, 'TxAuto', [('AutoRFOff', 7, 1), ('Force100ASK', 6, 1), ('AutoWakeUp', 5, 1), ('CAOn', 3, 1),
+                                ('InitialRFOn', 2, 1), ('Tx2RFAutoEn', 1, 1), ('Tx1RFAutoEn', 0, 1)]),
+    Register(0x6306, 'TxSel', [('DriverSel', 4, 2), ('SigOutSel', 0, 4)]),
+    Register(0x6307, 'RxSel', [('UartSel', 6, 2), ('RxWait', 0, 6)]),
+    Register(0x6308, 'RxThreshold', [('MinLevel', 4, 4), ('CollLevel', 0, 3)]),
+    Register(0x6309, 'Demod', [('AddIQ', 6, 2), ('FixIQ', 5, 1), ('TauRcv', 2, 2), ('TauSync', 0, 2)]),
+    Register(0x630a, 'FelNFC1', [('FelSyncLen', 6, 2), ('DataLenMin', 0, 6)]),
+    Register(0x630b, 'FelNFC2', [('WaitForSelected', 7, 1), ('ShortTimeSlot', 6, 1), ('DataLenMax', 0, 6)]),
+    Register(0x630c, 'MifNFC', [('SensMiller', 5, 3), ('TauMiller', 3, 2), ('TxWait', 0, 2)]),
+    Register(0x630d, 'ManualRCV', [('FastFilterMF_SO', 6, 1), ('DelayMF_SO', 5, 1), ('ParityDisable', 4, 1),
+                                   ('LargeBWPLL', 3, 1), ('ManualHPCF', 2, 1), ('HPCF', 0, 2)]),
+    Register(0x630e, 'TypeB', [('RxSOFReq', 7, 1), ('RxEOFReq', 6, 1), ('EOFSOFWidth', 4, 1), ('NoTxSOF', 3, 1),
+                               ('NoTxEOF', 2, 1), ('TxEGT', 0, 2)]),
+    Register(0x6311, 'CRCResultMSB'),
+    Register(0x6312, 'CRCResultLSB'),
+    Register(0x6313, 'GsNOff', [('CWGsNOff', 4, 4), ('ModGsNOff', 0, 4)]),
+    Register(0x6314, 'ModWidth'),
+    Register(0x6315, 'TxBitPhase', [('RcvClkChange', 7, 1), ('TxBitPhase', 0, 7)]),
+    Register(0x6316, 'RFCfg', [('RxGain', 4, 3), ('RFLevel', 0, 4)]),
+    Register(0x6317, 'GsNOn', [('CWGsNOn', 4, 4), ('ModGsNOn', 0, 4)]),
+    Register(0x6318, 'CWGsP', [('CWGsP', 0, 6)]),
+    Register(0x6319, 'ModGsP', [('ModGsP', 0, 6)]),
+    Register(0x631a, 'TMode', [('TAuto', 7, 1), ('TGated', 5, 2), ('TAutoRestart', 4, 1), ('TPrescalerHi', 0, 4)]),
+    Register(0x631b, 'TPrescalerLo'),
+    Register(0x631c, 'TReloadValHi'),
+    Register(0x631d, 'TReloadValLo'),
+    Register(0x631e, 'TCounterValHi'),
+    Register(0x631f, 'TCounterValLo'),
+    Register(0x6331, 'Command', [('RcvOff', 5, 1), ('PowerDown', 4, 1), ('Command', 0, 4)]),
+    Register(0x6336, 'Error', [('WrErr', 7, 1), ('TempErr', 6, 1), ('RFErr', 5, 1), ('BufferOvfl', 4, 1),
+                               ('CollErr', 3, 1), ('CRCErr', 2, 1), ('ParityErr', 1, 1), ('ProtocolErr', 0, 1)]),
+    Register(0x6337, 'Status1', [('CRCOk', 6, 1), ('CRCReady', 5, 1), ('CIUIRq', 4, 1), ('TRunning', 3, 1),
+                                 ('RFOn', 2, 1), ('HiAlert', 1, 1), ('LoAlert', 0, 1)]),
+    Register(0x6338, 'Status2', [('TempSensClear', 7, 1), ('I2CForceHS', 6, 1), ('MFCrypto1On', 3, 1), ('Modem', 0, 3)]),
+    Register(0x633c, 'Control', [('TStopNow', 7, 1), ('TStartNow', 6, 1), ('WrNFCIDtoFIFO', 5, 1),
+                                 ('Initiator', 4, 1), ('RxLastBits', 0, 3)]),
+    Register(0x633d, 'BitFraming', [('StartSend', 7, 1), ('RxAlign', 4, 3), ('TxLastBits', 0, 3)]),
+    # SFRs for the GPIO ports
+    Register(0xffb0, 'P3'),
+    Register(0xfff4, 'P7CFGA'),
+    Register(0xfff5, 'P7CFGB'),
+    Register(0xfff7, 'P7'),
+    Register(0xfffc, 'P3CFGA'),
+    Register(0xfffd, 'P3CFGB'),
+)
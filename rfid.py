@@ -1,11 +1,28 @@
 #!/usr/bin/env python
 
+import os
+import re
+import sys
 import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
 import smartcard
+from smartcard.pcsc.PCSCReader import PCSCReader
 from smartcard.CardConnectionObserver import ConsoleCardConnectionObserver
 from smartcard.util import toHexString, toASCIIString, toASCIIBytes
 from smartcard.ATR import ATR
 from smartcard.Exceptions import SmartcardException, NoReadersException, CardConnectionException, NoCardException
+from .apdu import APDU
+from .common import Deadline, TagException, private_dir
+from . import targets
+from .registers import REGISTERS
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks between processes, just between threads
+    fcntl = None
 
 # Try to use pyscard exceptions so it's easier to catch
 class UnsupportedReaderException(SmartcardException):
@@ -17,9 +34,27 @@ class ReaderException(SmartcardException):
 class PN532Exception(SmartcardException):
     pass
 
+class TagStatusException(PN532Exception, TagException):
+    # The target answered with an error (e.g. a NAK or failed authentication),
+    # or didn't answer at all, as opposed to a problem with the reader
+    def __init__(self, status):
+        self.status = status
+        PN532Exception.__init__(self, 'Unexpected status %02x' % status)
+
 class SAMException(SmartcardException):
     pass
 
+class ReaderBusyException(SmartcardException):
+    pass
+
+class CommandTimeoutException(SmartcardException):
+    pass
+
+class CardResetException(SmartcardException):
+    # The card lost its state (nothing selected, and on an ACR122 no targets
+    # activated), so whatever was in progress has to start again
+    pass
+
 
 DEBUG = True
 DEBUG = False
@@ -36,8 +71,132 @@ http://www.ecma-international.org/publications/files/ECMA-ST-ARCH/ECMA-340%201st
 pyscard's Session() is a bit broken, so we define our own interface here.
 
 You can either poll Pcsc.readers(), or call Pcsc.reader(), which defaults to the first.
+Both go through a process-wide registry, so polling is cheap.
 """
 
+class ReaderRegistry(object):
+    """
+    Keeps one PC/SC context and the wrapped readers for the whole process.
+
+    Readers are only enumerated again when the PnP notification pseudo-reader
+    reports a change, or when someone calls invalidate() after an error.
+    Wrapped readers are kept by name, so a reader that's still plugged in
+    is returned as the same object (and can be reopened cheaply).
+    """
+    PNP_NOTIFICATION = '\\\\?PnP?\\Notification'
+
+    # Errors which mean the context itself is no good
+    CONTEXT_ERRORS = [
+        'SCARD_E_INVALID_HANDLE',
+        'SCARD_E_NO_SERVICE',
+        'SCARD_E_SERVICE_STOPPED',
+        'SCARD_E_INVALID_PARAMETER',
+    ]
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.hcontext = None
+        self.pnp_state = None
+        self.pnp_supported = True
+        self.stale = True
+        self.wrapped = OrderedDict()
+
+    def context(self):
+        with self.lock:
+            if self.hcontext is None:
+                self.hcontext = HResult(smartcard.scard.SCardEstablishContext(smartcard.scard.SCARD_SCOPE_USER))
+                self.pnp_state = None
+                self.stale = True
+            return self.hcontext
+
+    def release(self):
+        with self.lock:
+            if self.hcontext is not None:
+                try:
+                    HResult(smartcard.scard.SCardReleaseContext(self.hcontext))
+                except HResultException:
+                    # Probably why we're releasing it
+                    pass
+            self.hcontext = None
+            self.stale = True
+
+    def invalidate(self, error=None):
+        # Call this when something goes wrong talking to a reader
+        with self.lock:
+            self.stale = True
+            if error is None or self.is_context_error(error):
+                self.release()
+
+    def is_context_error(self, error):
+        hresult = getattr(error, 'hresult', None)
+        codes = [getattr(smartcard.scard, name, None) for name in self.CONTEXT_ERRORS]
+        return hresult in codes
+
+    def changed(self):
+        # A zero-timeout SCardGetStatusChange is much cheaper than listing readers
+        if not self.pnp_supported:
+            return True
+
+        hcontext = self.context()
+        if self.pnp_state is None:
+            self.pnp_state = [(self.PNP_NOTIFICATION, smartcard.scard.SCARD_STATE_UNAWARE)]
+
+        hresult, states = smartcard.scard.SCardGetStatusChange(hcontext, 0, self.pnp_state)
+        if hresult == smartcard.scard.SCARD_E_TIMEOUT:
+            return False
+        HResult(hresult)
+
+        name, event, atr = states[0]
+        if event & smartcard.scard.SCARD_STATE_UNKNOWN:
+            # Not every resource manager supports this
+            self.pnp_supported = False
+            return True
+
+        self.pnp_state = [(name, event & ~smartcard.scard.SCARD_STATE_CHANGED)]
+        return bool(event & smartcard.scard.SCARD_STATE_CHANGED)
+
+    def names(self):
+        hresult, names = smartcard.scard.SCardListReaders(self.context(), [])
+        if hresult == smartcard.scard.SCARD_E_NO_READERS_AVAILABLE:
+            return []
+        HResult(hresult)
+        return names
+
+    def refresh(self):
+        names = self.names()
+
+        wrapped = OrderedDict()
+        for name in names:
+            reader = self.wrapped.get(name)
+            if reader is None:
+                reader = Pcsc.wrapreader(PCSCReader(name))
+            wrapped[name] = reader
+
+        self.wrapped = wrapped
+        self.stale = False
+
+    def readers(self):
+        with self.lock:
+            try:
+                if self.changed():
+                    self.stale = True
+                if self.stale:
+                    self.refresh()
+
+            except HResultException as e:
+                # Try once more with a fresh context
+                self.invalidate(e)
+                self.refresh()
+
+            return list(self.wrapped.values())
+
+    def reader(self, name):
+        with self.lock:
+            if name not in self.wrapped:
+                self.readers()
+            return self.wrapped[name]
+
+
 class Pcsc(object):
     @classmethod
     def wrapreader(self, reader):
@@ -48,8 +207,7 @@ class Pcsc(object):
 
     @classmethod
     def readers(self):
-        readers = list(map(self.wrapreader, smartcard.System.readers()))
-        return readers
+        return registry.readers()
 
     @classmethod
     def reader(self, readernum=None):
@@ -65,28 +223,482 @@ class Pcsc(object):
         return readers[readernum]
 
 
+class ReaderLock(object):
+    """
+    Advisory lock so cooperating processes on this host take turns with a reader.
+
+    Waiters add themselves to a queue in the lock file and the lock belongs
+    to whoever is first, so nobody is starved. Entries left behind by dead
+    processes are dropped. The file itself is only flocked while the queue
+    is being updated.
+
+    By default the file goes in a directory only this user can get into,
+    so nobody else can fill the queue. To share a reader with other users'
+    processes, give a directory (and mode) that they can use too.
+    """
+    def __init__(self, name, directory=None, poll=0.005, mode=0o600):
+        if directory is None:
+            directory = private_dir()
+        filename = 'rfuid-%s.lock' % re.sub(r'[^A-Za-z0-9._-]', '_', name)
+        self.path = os.path.join(directory, filename)
+        self.mode = mode
+        self.poll = poll
+        self.token = None
+        self.depth = 0
+        self.local = threading.RLock()
+
+    def update(self, change=None):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, self.mode)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+            data = os.read(fd, 0x10000).decode('ascii')
+            queue = [t for t in data.split() if self.alive(t)]
+            if change is not None:
+                queue = change(queue)
+
+            new = ''.join('%s\n' % t for t in queue)
+            if new != data:
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, new.encode('ascii'))
+            return queue
+
+        finally:
+            # Closing also drops the flock
+            os.close(fd)
+
+    def alive(self, token):
+        try:
+            pid = int(token.split(':')[0])
+            os.kill(pid, 0)
+        except ValueError:
+            return False
+        except OSError as e:
+            # EPERM means it exists but isn't ours
+            return e.errno == 1
+        return True
+
+    def acquire(self, timeout=None):
+        if not self.local.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+
+        if self.depth:
+            self.depth += 1
+            return True
+
+        if fcntl is None:
+            self.depth = 1
+            return True
+
+        token = '%d:%d:%d' % (os.getpid(), threading.current_thread().ident, id(self))
+        try:
+            self.update(lambda q: q + [token])
+
+            start = time.time()
+            while True:
+                queue = self.update()
+                if queue[:1] == [token]:
+                    self.token = token
+                    self.depth = 1
+                    return True
+
+                if token not in queue:
+                    # Someone's cleared out the file
+                    self.update(lambda q: q + [token])
+
+                if timeout is not None and time.time() - start > timeout:
+                    break
+
+                time.sleep(self.poll)
+
+        except BaseException:
+            # e.g. KeyboardInterrupt. We're still alive, so a token left
+            # in the queue would hold everyone else up for good
+            self.withdraw(token)
+            raise
+
+        self.withdraw(token)
+        return False
+
+    def withdraw(self, token):
+        try:
+            self.update(lambda q: [t for t in q if t != token])
+        except OSError:
+            pass
+        finally:
+            self.local.release()
+
+    def release(self):
+        self.depth -= 1
+        if not self.depth and self.token is not None:
+            token, self.token = self.token, None
+            self.update(lambda q: [t for t in q if t != token])
+        self.local.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class CommandWorker(object):
+    """
+    Runs a reader's commands on its own thread, so callers can stop waiting
+    when their deadline passes.
+
+    PC/SC calls can't be interrupted, so a command that timed out carries on
+    in the background. Until it finishes, anything else sent to the reader
+    fails straight away with ReaderBusyException instead of queueing behind it.
+    The thread exits after being idle for a while, and starts again when needed.
+    """
+    def __init__(self, name, idle=30):
+        self.name = name
+        self.idle = idle
+        self.cond = threading.Condition()
+        self.thread = None
+        # Each job is [fn, args, result]
+        self.pending = None
+        self.current = None
+        # The current job's caller has given up on it
+        self.abandoned = False
+
+    def in_worker(self):
+        return threading.current_thread() is self.thread
+
+    def busy(self):
+        return self.abandoned
+
+    def run(self, fn, args, deadline, on_timeout):
+        job = [fn, args, {}]
+        result = job[2]
+        with self.cond:
+            while self.pending is not None or self.current is not None:
+                if self.abandoned:
+                    raise ReaderBusyException('%s is still running a command that timed out' % self.name)
+                remaining = deadline.remaining()
+                if remaining <= 0:
+                    raise CommandTimeoutException('Timed out waiting for %s' % self.name)
+                self.cond.wait(remaining)
+
+            self.pending = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name='command %s' % self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+
+            while 'done' not in result:
+                remaining = deadline.remaining()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            timed_out = 'done' not in result
+            if timed_out:
+                if self.pending is job:
+                    # Never started, so nothing to wait for
+                    self.pending = None
+                    timed_out = False
+                else:
+                    self.abandoned = True
+
+        if 'done' not in result:
+            if timed_out:
+                on_timeout()
+            raise CommandTimeoutException('No response from %s within %.3fs' % (self.name, deadline.timeout))
+
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def loop(self):
+        while True:
+            with self.cond:
+                if self.pending is None:
+                    self.cond.wait(self.idle)
+                    if self.pending is None:
+                        self.thread = None
+                        return
+                    continue
+
+                self.current, self.pending = self.pending, None
+                fn, args, result = self.current
+
+            try:
+                result['value'] = fn(*args)
+            except BaseException as e:
+                result['error'] = e
+
+            with self.cond:
+                result['done'] = True
+                self.current = None
+                self.abandoned = False
+                self.cond.notify_all()
+
+
 class PcscReader(object):
+    # pyscard connects in shared mode by default
+    SHARE = 'shared'
+    SHARE_MODES = {
+        'exclusive': smartcard.scard.SCARD_SHARE_EXCLUSIVE,
+        'shared': smartcard.scard.SCARD_SHARE_SHARED,
+        'direct': smartcard.scard.SCARD_SHARE_DIRECT,
+    }
+
     def __init__(self, reader):
         self.reader = reader
         self.name = reader.name
+        self.conn = None
+        self.connection = None
+        self.share = self.SHARE
+        # Only used if opened with share='shared' (see set_share)
+        self.host_lock = None
+        # Where the host lock file goes, if not a directory only we can use
+        self.lock_dir = None
+        # Only one thread at a time gets the card transaction, and each
+        # thread's nesting depth is its own (see card_transaction)
+        self.transaction_lock = threading.RLock()
+        self.transaction_local = threading.local()
+        self.transaction_open = False
+        self.recovery = Recovery(self)
+        # Each thread's budget() deadline
+        self.session = threading.local()
+        self.worker = CommandWorker(self.name)
+        self.cancelled = False
 
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.name)
 
-    def open(self):
-        self.conn = self.reader.createConnection()
-        self.conn.connect()
+    def open(self, share=None):
+        self.set_share(share)
 
-        if DEBUG:
-            observer = ConsoleCardConnectionObserver()
-            self.conn.addObserver(observer)
+        # pyscard sets up a context per connection, so hang on to it
+        if self.connection is None:
+            self.connection = self.reader.createConnection()
+
+            if DEBUG:
+                observer = ConsoleCardConnectionObserver()
+                self.connection.addObserver(observer)
+
+        self.conn = self.connection
+        try:
+            self.conn.connect(mode=self.SHARE_MODES[self.share])
+        except NoCardException:
+            raise
+        except CardConnectionException as e:
+            # The reader may have gone away
+            self.connection = None
+            self.conn = None
+            registry.invalidate(e)
+            raise
 
     def close(self):
         # PCSCCardConnection.__del__ calls disconnect, but
         # let's do it in case someone's taken a reference
         self.conn.disconnect()
         self.conn = None
-        self.reader = None
+
+    DISPOSITIONS = {
+        'leave': smartcard.scard.SCARD_LEAVE_CARD,
+        'reset': smartcard.scard.SCARD_RESET_CARD,
+        'unpower': smartcard.scard.SCARD_UNPOWER_CARD,
+    }
+
+    def reconnect(self, disposition='leave'):
+        # Much quicker than close() and open(), as nothing is set up again
+        self.conn.reconnect(mode=self.SHARE_MODES[self.share], disposition=self.DISPOSITIONS[disposition])
+        self.resume_transaction()
+        self.reconnected(disposition)
+
+    def reopen(self):
+        # The card gets powered down
+        self.card_reset()
+        try:
+            PcscReader.close(self)
+        except (SmartcardException, HResultException):
+            pass
+        self.open()
+        self.resume_transaction()
+
+    def known_tags(self):
+        tag = getattr(self, 'tag', None)
+        return [tag] if tag is not None else []
+
+    def card_reset(self):
+        # Nothing that was selected is any more
+        for tag in self.known_tags():
+            tag.reset()
+
+    def reconnected(self, disposition):
+        if disposition == 'leave':
+            # Still as it was, except that a failed or cancelled
+            # command may have changed what's selected
+            for tag in self.known_tags():
+                tag.forget_selections()
+        else:
+            self.card_reset()
+
+    def resume_transaction(self):
+        # Reconnecting ends any transaction we were in the middle of
+        if self.transaction_open:
+            HResult(smartcard.scard.SCardBeginTransaction(self.card_handle()))
+
+    # How to get the card back into a known state after a cancelled command
+    CANCEL_DISPOSITION = 'reset'
+
+    def context_handle(self):
+        conn = getattr(self.conn, 'component', self.conn)
+        return getattr(conn, 'hcontext', None)
+
+    @contextmanager
+    def budget(self, timeout):
+        """
+        Bound the total time of everything sent within this block, e.g.
+
+            with reader.budget(0.3):
+                uid = tag.find_unique_id()
+
+        Only commands sent from the same thread count against it.
+        """
+        previous = getattr(self.session, 'deadline', None)
+        self.session.deadline = Deadline.earliest(previous, timeout)
+        try:
+            yield self.session.deadline
+        finally:
+            self.session.deadline = previous
+
+    def with_deadline(self, deadline, fn, *args):
+        if self.worker.in_worker():
+            # Already being timed from further up
+            return fn(*args)
+
+        if self.worker.busy():
+            # Don't queue up behind a command nobody's waiting for
+            raise ReaderBusyException('%s is still running a command that timed out' % self.name)
+
+        deadline = Deadline.earliest(deadline, getattr(self.session, 'deadline', None))
+        if deadline is None:
+            return fn(*args)
+
+        if deadline.expired():
+            raise CommandTimeoutException('Deadline passed before sending to %s' % self.name)
+
+        # PC/SC calls can't be interrupted, so wait for them on the worker thread
+        depth = self.transaction_depth()
+        return self.worker.run(self.run_within, (depth, fn, args), deadline, self.cancel)
+
+    def run_within(self, depth, fn, args):
+        # On the worker thread, carrying on in the caller's transaction
+        self.transaction_local.depth = depth
+        try:
+            return fn(*args)
+        finally:
+            self.transaction_local.depth = 0
+
+    def cancel(self):
+        # The next command will reconnect first, once the stuck one gives up
+        self.cancelled = True
+        hcontext = self.context_handle()
+        if hcontext is not None:
+            try:
+                smartcard.scard.SCardCancel(hcontext)
+            except Exception:
+                pass
+
+    def check_cancelled(self):
+        if self.cancelled:
+            self.cancelled = False
+            self.reconnect(self.CANCEL_DISPOSITION)
+            if self.CANCEL_DISPOSITION != 'leave':
+                raise CardResetException('%s was reset after a cancelled command' % self.name)
+
+    def set_share(self, share):
+        # Only asking for shared mode explicitly queues transactions on the
+        # host lock, as that's when we expect someone else to be using the reader
+        if share is None:
+            return
+
+        self.share = share
+        if share != 'shared':
+            self.host_lock = None
+        elif self.host_lock is None:
+            self.host_lock = ReaderLock(self.name, self.lock_dir)
+
+    def card_handle(self):
+        conn = getattr(self.conn, 'component', self.conn)
+        return conn.hcard
+
+    def transaction_depth(self):
+        return getattr(self.transaction_local, 'depth', 0)
+
+    @contextmanager
+    def card_transaction(self, timeout=None):
+        # A PC/SC transaction, unless this thread's already in one. PC/SC
+        # transactions belong to the handle, so other threads wait for it
+        # to end rather than joining in
+        depth = self.transaction_depth()
+        if depth:
+            self.transaction_local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.transaction_local.depth = depth
+            return
+
+        if not self.transaction_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise ReaderBusyException('Timed out waiting for %s' % self.name)
+
+        try:
+            HResult(smartcard.scard.SCardBeginTransaction(self.card_handle()))
+            self.transaction_open = True
+            self.transaction_local.depth = 1
+            try:
+                yield
+            finally:
+                self.transaction_local.depth = 0
+                self.transaction_open = False
+                # The handle may have changed if we had to reopen
+                HResult(smartcard.scard.SCardEndTransaction(self.card_handle(), smartcard.scard.SCARD_LEAVE_CARD))
+        finally:
+            self.transaction_lock.release()
+
+    @contextmanager
+    def transaction(self, timeout=None):
+        """
+        Use this around a sequence of commands that mustn't be interleaved
+        with anyone else's, e.g. SELECT followed by GPO.
+
+        If the reader was opened with share='shared', this first queues on
+        the host lock, so cooperating processes get the reader in turn. The
+        lock is taken once for the whole block, not for each command.
+        Other threads using the same reader wait for the block to finish.
+        """
+        deadline = Deadline.coerce(timeout)
+        host_lock = self.host_lock if not self.transaction_depth() else None
+        if host_lock is not None and not host_lock.acquire(timeout):
+            raise ReaderBusyException('Timed out waiting for %s' % self.name)
+
+        try:
+            with self.card_transaction(None if deadline is None else max(0, deadline.remaining())):
+                yield
+        finally:
+            if host_lock is not None:
+                host_lock.release()
+
+    @contextmanager
+    def atomic(self):
+        # Keeps a command and its GET RESPONSE together. Nobody can get in
+        # between on an exclusive connection, so only shared ones need a
+        # PC/SC transaction for that
+        if self.share == 'shared':
+            with self.card_transaction():
+                yield
+        else:
+            yield
 
     def __enter__(self):
         self.open()
@@ -97,48 +709,13 @@ class PcscReader(object):
 
 
 class UnsupportedReader(PcscReader):
-    def open(self):
+    def open(self, share=None):
         raise UnsupportedReaderException(self.name)
 
     def close(self):
         pass
 
 
-class APDU(object):
-    def __init__(self, cls, ins, p1=0, p2=0, lc=None, data=None, le=None):
-        self.cls = cls
-        self.ins = ins
-        self.p1 = p1
-        self.p2 = p2
-        if data is None:
-            data = []
-        self.data = data
-        if lc is None:
-            lc = len(data)
-        self.lc = lc
-        self.le = []
-        if le is not None:
-            self.le = [le]
-
-    @property
-    def bytes(self):
-        if len(self.data) > 255:
-            raise ValueError('APDU payload too long')
-        return [self.cls, self.ins, self.p1, self.p2, self.lc] + self.data + self.le
-
-    def __iter__(self):
-        return iter(self.bytes)
-
-    @classmethod
-    def frombytes(self, bytes):
-        args = bytes[:5]
-        lc = bytes[4]
-        if 5 + lc != len(bytes):
-            raise ValueError('Length %s is incorrect for APDU length %s' % (5 + lc, len(bytes)))
-        args.append(bytes[5:])
-        return APDU(*args)
-
-
 class BasicChipReader(PcscReader):
     def open(self):
         PcscReader.open(self)
@@ -167,10 +744,14 @@ class BasicChipReader(PcscReader):
     def tags(self):
         return [self.tag]
 
-    def send_to_tag(self, tag, apdu):
+    def send_to_tag(self, tag, apdu, deadline=None):
         if tag is not None:
             raise ValueError('Multiple tags not supported')
 
+        return self.with_deadline(deadline, self.transmit, apdu)
+
+    def transmit(self, apdu):
+        self.check_cancelled()
         resp, sw1, sw2 = self.conn.transmit(list(apdu))
         if sw1 == 0x61:  # More data
             apdu2 = APDU(0, 0xc0, lc=sw2)
@@ -180,28 +761,180 @@ class BasicChipReader(PcscReader):
 
 
 class HResultException(Exception):
-    pass
+    def __init__(self, hresult):
+        self.hresult = hresult
+        Exception.__init__(self, 'hResult was 0x%08x' % (hresult & 0xffffffff))
 
 def HResult(vals):
     if not isinstance(vals, (tuple, list)):
         vals = (vals,)
     hresult = vals[0]
-    if hresult < 0:
-        raise HResultException('hResult was 0x%08x' % hresult)
+    if hresult != 0:
+        raise HResultException(hresult)
     if len(vals) == 1:
         return None
     if len(vals) == 2:
         return vals[1]
     return vals[1:]
 
+# Errors that a reconnect should fix, and how to reconnect
+TRANSIENT_ERRORS = {
+    'SCARD_E_SHARING_VIOLATION': 'leave',
+    'SCARD_W_RESET_CARD': 'leave',
+    'SCARD_W_REMOVED_CARD': 'leave',
+    'SCARD_E_NOT_TRANSACTED': 'reset',
+    'SCARD_E_COMM_DATA_LOST': 'reset',
+    'SCARD_W_UNRESPONSIVE_CARD': 'reset',
+    'SCARD_W_UNPOWERED_CARD': 'reset',
+    'SCARD_E_TIMEOUT': 'reset',
+}
+# Reconnecting with 'leave' is enough to carry on after these, but someone
+# else has already reset the card, or it may be a different card
+CARD_CHANGED_ERRORS = ['SCARD_W_RESET_CARD', 'SCARD_W_REMOVED_CARD']
+
+def classify_error(error):
+    """
+    Returns ('retry', 'leave') for errors where a reconnect leaves the card
+    as the command found it, so the command can be sent again.
+    ('reset', disposition) means the card loses its state either way, and
+    ('fatal', None) is anything that needs the reader reopening.
+    """
+    hresult = getattr(error, 'hresult', None)
+    for name, disposition in TRANSIENT_ERRORS.items():
+        code = getattr(smartcard.scard, name, None)
+        if code is not None and hresult == code:
+            if disposition == 'leave' and name not in CARD_CHANGED_ERRORS:
+                return 'retry', disposition
+            return 'reset', disposition
+
+    return 'fatal', None
+
+
+class RetryPolicy(object):
+    def __init__(self, retries=3, backoff=0.001, max_backoff=0.02, budget=20, period=60):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Reconnects allowed per reader in each period, before we give up and reopen
+        self.budget = budget
+        self.period = period
+
+    def delays(self):
+        delay = self.backoff
+        for i in range(self.retries):
+            yield delay
+            delay = min(delay * 2, self.max_backoff)
+
+
+class Recovery(object):
+    """
+    Retries a reader operation after PC/SC errors.
+
+    Errors that SCardReconnect can fix without touching the card are
+    retried after a reconnect and a short backoff, which takes a few ms.
+
+    Anything that resets the card (or may have swapped it) isn't retried,
+    as nothing would be selected any more and the command may not be safe
+    to repeat (e.g. GPO). The reader reconnects, or reopens for fatal
+    errors and when out of retries or budget, then its tags forget their
+    state and CardResetException tells the caller to start again.
+    """
+    def __init__(self, reader, policy=None):
+        if policy is None:
+            policy = RetryPolicy()
+        self.reader = reader
+        self.policy = policy
+        self.spent = []
+        self.local = threading.local()
+        self.stats = dict(reconnects=0, resets=0, reopens=0, failures=0)
+
+    def allowed(self):
+        now = time.time()
+        self.spent = [t for t in self.spent if now - t < self.policy.period]
+        return len(self.spent) < self.policy.budget
+
+    def call(self, fn, *args):
+        if getattr(self.local, 'active', False):
+            # Let the outermost operation handle it
+            return fn(*args)
+
+        self.local.active = True
+        try:
+            return self.attempt(fn, args)
+        finally:
+            self.local.active = False
+
+    def attempt(self, fn, args):
+        delays = self.policy.delays()
+        while True:
+            try:
+                return fn(*args)
+            except (SmartcardException, HResultException) as e:
+                if isinstance(e, (NoCardException, PN532Exception, ReaderException, TagException,
+                                  CommandTimeoutException, ReaderBusyException, CardResetException)):
+                    # Nothing wrong with the connection, or already dealt with
+                    raise
+
+                kind, disposition = classify_error(e)
+                delay = next(delays, None)
+                if kind == 'fatal' or delay is None or not self.allowed():
+                    self.escalate(e)
+
+                if DEBUG:
+                    print('Reconnecting (%s) after %r' % (disposition, e))
+
+                time.sleep(delay)
+                self.spent.append(time.time())
+                self.stats['reconnects'] += 1
+                try:
+                    self.reader.reconnect(disposition)
+                except (SmartcardException, HResultException) as e2:
+                    if kind == 'reset' or classify_error(e2)[0] == 'fatal':
+                        self.escalate(e2)
+                    continue
+
+                if kind == 'reset':
+                    self.reset(e)
+
+    def reset(self, error):
+        self.stats['resets'] += 1
+        self.reader.card_reset()
+        raise CardResetException('%s lost its state after %r' % (self.reader.name, error))
+
+    def escalate(self, error):
+        self.stats['reopens'] += 1
+        registry.invalidate(error)
+        try:
+            self.reader.reopen()
+        except (SmartcardException, HResultException):
+            self.stats['failures'] += 1
+            raise error
+
+        self.reset(error)
+
+
 class LowLevelChipReader(PcscReader):
     """
     Some cards (or just Gemalto readers?) fails with "656e Error, changed" unless you do this
     """
-    def open(self):
-        self.hcontext = HResult(smartcard.scard.SCardEstablishContext(smartcard.scard.SCARD_SCOPE_USER))
+    SHARE = 'exclusive'
+
+    def open(self, share=None):
+        self.set_share(share)
+
+        try:
+            self.connect()
+        except HResultException as e:
+            if not registry.is_context_error(e):
+                raise
+            # pcscd has probably restarted
+            registry.invalidate(e)
+            self.connect()
+
+    def connect(self):
+        self.hcontext = registry.context()
         self.hcard, dwActiveProtocol = HResult(smartcard.scard.SCardConnect(
-            self.hcontext, self.name, smartcard.scard.SCARD_SHARE_EXCLUSIVE, smartcard.scard.SCARD_PROTOCOL_T0))
+            self.hcontext, self.name, self.SHARE_MODES[self.share], smartcard.scard.SCARD_PROTOCOL_T0))
 
         self.tag = Tag(self, None, None, None)
         self.tag.uid = None
@@ -210,16 +943,43 @@ class LowLevelChipReader(PcscReader):
     def close(self):
         HResult(smartcard.scard.SCardDisconnect(self.hcard, smartcard.scard.SCARD_LEAVE_CARD))
 
+    def reopen(self):
+        self.card_reset()
+        try:
+            self.close()
+        except HResultException:
+            pass
+        self.open()
+        self.resume_transaction()
+
+    def card_handle(self):
+        return self.hcard
+
+    def reconnect(self, disposition='leave'):
+        HResult(smartcard.scard.SCardReconnect(
+            self.hcard, self.SHARE_MODES[self.share], smartcard.scard.SCARD_PROTOCOL_T0, self.DISPOSITIONS[disposition]))
+        self.resume_transaction()
+        self.reconnected(disposition)
+
     @property
     def tags(self):
         return [self.tag]
 
-    def send_to_tag(self, tag, apdu):
+    def context_handle(self):
+        return self.hcontext
+
+    def send_to_tag(self, tag, apdu, deadline=None):
         if tag is not None:
             raise ValueError('Multiple tags not supported')
 
-        HResult(smartcard.scard.SCardBeginTransaction(self.hcard))
+        return self.with_deadline(deadline, self.recovery.call, self.transact, apdu)
+
+    def transact(self, apdu):
+        self.check_cancelled()
+        with self.card_transaction():
+            return self.transmit(apdu)
 
+    def transmit(self, apdu):
         if DEBUG:
             print('> %s' % toHexString(list(apdu)))
 
@@ -237,41 +997,271 @@ class LowLevelChipReader(PcscReader):
             if DEBUG:
                 print('< %s' % toHexString(response))
 
-        HResult(smartcard.scard.SCardEndTransaction(self.hcard, smartcard.scard.SCARD_LEAVE_CARD))
-
         return response
 
 
+class Feedback(object):
+    """
+    Sends LED/buzzer updates for an AcsReader without holding up card commands.
+
+    Updates are queued and merged, so only the latest state is sent. If the
+    reader accepts escape commands through SCardControl they go out straight
+    away, otherwise they wait until the reader has been idle for a while.
+    """
+    def __init__(self, reader, idle=0.05):
+        self.reader = reader
+        self.idle = idle
+        self.cond = threading.Condition()
+        self.pending = None
+        self.thread = None
+        self.running = False
+
+    def merge(self, pending, state):
+        if pending is None:
+            pending = {}
+        else:
+            pending = dict(pending)
+
+        if 'blink' not in state:
+            # The blink and buzzer pattern belonged to the old LED state
+            pending.pop('blink', None)
+            pending.pop('buzzer', None)
+
+        pending.update(state)
+        return pending
+
+    def update(self, **state):
+        with self.cond:
+            self.pending = self.merge(self.pending, state)
+            self.cond.notify()
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name='feedback %s' % self.reader.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, flush=True):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if flush:
+            self.flush()
+
+    def take(self):
+        with self.cond:
+            state, self.pending = self.pending, None
+        return state
+
+    def flush(self):
+        # Call this between card transactions to send anything outstanding
+        state = self.take()
+        if state is not None:
+            self.send(state)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and self.pending is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+
+                if self.reader.control_available is False:
+                    busy = self.idle - self.reader.idle_time()
+                    if busy > 0:
+                        # Something else may arrive in the meantime
+                        self.cond.wait(busy)
+                        continue
+
+                state, self.pending = self.pending, None
+
+            try:
+                self.send(state)
+            except SmartcardException as e:
+                if DEBUG:
+                    print('Error sending feedback: %r' % e)
+
+    def send(self, state):
+        apdu = self.reader.led_buzzer_apdu(**state)
+        if self.reader.control_available is not False:
+            # None means we haven't tried yet
+            try:
+                self.reader.send_control(apdu)
+                return
+            except SmartcardException:
+                self.reader.control_available = False
+
+        # Don't split a card exchange in half
+        with self.reader.lock:
+            self.reader.send_led_buzzer(apdu)
+
+
 class AcsReader(PcscReader):
+    # Probed capabilities, keyed by (reader name, firmware version)
+    CAPABILITIES = {}
+    # Reader name to (ATR, firmware version), so we can find the above without asking
+    KNOWN_READERS = {}
+
     def __init__(self, reader):
         PcscReader.__init__(self, reader)
         self.pn532 = Pn532(self)
-
-    def open(self):
-        PcscReader.open(self)
+        self.tracker = TagTracker(self.pn532)
+        self.lock = threading.RLock()
+        self.last_used = 0
+        self.control_available = None
+        self.feedback = None
+        self.capabilities = None
+        # RFConfiguration items to send on every open
+        self.radio_config = OrderedDict([
+            (5, [0, 0, 0]),  # set_retries(0, 0, 0)
+        ])
+
+    def open(self, share=None):
+        PcscReader.open(self, share)
 
         # We could pass this into connect, but this is clearer
-        self.atr = ATR(self.conn.getATR())
+        atr = self.conn.getATR()
+        caps = self.cached_capabilities(atr)
+        if caps is None:
+            caps = self.probe_capabilities(atr)
+
+        self.capabilities = caps
+        self.atr = caps['atr']
         if DEBUG:
             print('ATR: %s' % self.atr)
             self.atr.dump()
+            print('Firmware version %s' % caps['firmware'])
 
-        if not self.atr.isT0Supported():
+        if 'T0' not in caps['protocols']:
             self.close()
             raise CardConnectionException('Reader reports T0 protocol not supported')
 
-        if DEBUG:
-            print('Firmware version %s' % self.firmware_version())
+        if self.control_available is None:
+            self.control_available = caps['escape']
+
+        self.apply_radio_config()
+
+    def cached_capabilities(self, atr):
+        known = self.KNOWN_READERS.get(self.name)
+        if known is None:
+            return None
+
+        known_atr, firmware = known
+        if known_atr != list(atr):
+            # Something's changed (e.g. a SAM's been added), so probe again
+            return None
+
+        return self.CAPABILITIES.get((self.name, firmware))
+
+    def probe_capabilities(self, atr):
+        # Only done the first time we see a reader
+        parsed = ATR(atr)
+        protocols = []
+        if parsed.isT0Supported():
+            protocols.append('T0')
+        if parsed.isT1Supported():
+            protocols.append('T1')
+        if parsed.isT15Supported():
+            protocols.append('T15')
+
+        caps = dict(
+            atr = parsed,
+            protocols = protocols,
+            sam = (parsed.TS, parsed.T0) != (0x3b, 0),
+            firmware = None,
+            pn532 = None,
+            escape = False,
+        )
 
-        self.pn532.set_retries(0, 0, 0)
+        if 'T0' in protocols:
+            caps['firmware'] = self.firmware_version()
+            caps['pn532'] = self.pn532.firmware()
 
-    def send(self, apdu):
-        resp, sw1, sw2 = self.conn.transmit(list(apdu))
+            try:
+                self.send_control(APDU(0xff, 0, 0x48))
+                caps['escape'] = True
+            except SmartcardException:
+                pass
+
+        self.CAPABILITIES[(self.name, caps['firmware'])] = caps
+        self.KNOWN_READERS[self.name] = list(atr), caps['firmware']
+        return caps
+
+    def apply_radio_config(self):
+        # One frame per item, as RFConfiguration only takes one at a time
+        for item, data in self.radio_config.items():
+            self.pn532.set_radio(item, data)
+
+    def tune_radio(self, **kwargs):
+        # Let retries and timeouts follow how this reader is doing (see RadioTuner)
+        self.pn532.tuner = RadioTuner(self, **kwargs)
+        return self.pn532.tuner
+
+    def close(self):
+        if self.feedback is not None:
+            self.feedback.stop()
+            self.feedback = None
+        self.tracker.forget()
+        PcscReader.close(self)
+
+    # Resetting would reset the PN532 as well
+    CANCEL_DISPOSITION = 'leave'
+
+    def known_tags(self):
+        return list(self.tracker.tags)
+
+    def card_reset(self):
+        PcscReader.card_reset(self)
+        # The PN532's been reset too, so its targets have to be found again
+        self.tracker.forget()
+        self.pn532.forget_targets()
+
+    def reconnected(self, disposition):
+        PcscReader.reconnected(self, disposition)
+        if disposition != 'leave':
+            # Retries and timeouts are back to the PN532's defaults
+            self.apply_radio_config()
+
+    def send(self, apdu, deadline=None):
+        return self.with_deadline(deadline, self.recovery.call, self.transmit, apdu)
+
+    def transmit(self, apdu):
+        with self.lock:
+            self.check_cancelled()
+            try:
+                resp, sw1, sw2 = self.conn.transmit(list(apdu))
+            finally:
+                self.last_used = time.time()
         return resp, sw1, sw2
 
+    def idle_time(self):
+        return time.time() - self.last_used
+
+    # The ACR122 accepts its pseudo-APDUs as escape commands too,
+    # which don't have to wait for a card exchange to finish.
+    # The ACS driver on Windows uses control code 3500, but the
+    # pcsc-lite CCID driver (Linux and macOS) uses 1.
+    ESCAPE_CODE = 3500 if sys.platform == 'win32' else 1
+
+    def send_control(self, apdu):
+        code = smartcard.scard.SCARD_CTL_CODE(self.ESCAPE_CODE)
+        resp = self.conn.control(code, list(apdu))
+        if len(resp) < 2:
+            raise ReaderException('Short response to escape command')
+        self.control_available = True
+        return resp[:-2], resp[-2], resp[-1]
+
     @property
     def tags(self):
-        return self.pn532.scan()
+        # Only rescans if the field has changed
+        return self.tracker.current()
 
 
     def firmware_version(self):
@@ -280,7 +1270,7 @@ class AcsReader(PcscReader):
         return toASCIIString(resp + [sw1, sw2])
 
 
-    def led_buzzer(self, red=None, green=None, blink=None, buzzer=None):
+    def led_buzzer_apdu(self, red=None, green=None, blink=None, buzzer=None):
         led_ctl = 0
         if red is not None:
             led_ctl |= 0x4
@@ -305,8 +1295,8 @@ class AcsReader(PcscReader):
         initial_delay, blink_delay, blink_count = 0, 0, 0
         if blink:
             initial_delay, blink_delay, blink_count = blink
-            initial_delay = initial_delay / 100
-            blink_delay = blink_delay / 100
+            initial_delay = initial_delay // 100
+            blink_delay = blink_delay // 100
 
         buzz_ctl = 0
         if buzzer:
@@ -317,7 +1307,9 @@ class AcsReader(PcscReader):
 
         extra = [initial_delay, blink_delay, blink_count, buzz_ctl]
 
-        apdu = APDU(0xff, 0, 0x40, led_ctl, data=extra)
+        return APDU(0xff, 0, 0x40, led_ctl, data=extra)
+
+    def send_led_buzzer(self, apdu):
         resp, sw1, sw2 = self.send(apdu)
         if sw1 != 0x90:
             raise ReaderException('Error setting LEDs %02x%02x' % (sw1, sw2))
@@ -325,24 +1317,41 @@ class AcsReader(PcscReader):
         red, green = list(map(bool, [sw2 & 0x1, sw2 & 0x2]))
         return red, green
 
+    def led_buzzer(self, red=None, green=None, blink=None, buzzer=None):
+        apdu = self.led_buzzer_apdu(red=red, green=green, blink=blink, buzzer=buzzer)
+        return self.send_led_buzzer(apdu)
+
+
+    def start_feedback(self, idle=0.05):
+        # After this, the helpers below queue their updates instead of blocking
+        if self.feedback is None:
+            self.feedback = Feedback(self, idle=idle)
+        self.feedback.start()
+        return self.feedback
+
+    def set_leds(self, **state):
+        if self.feedback is not None and self.feedback.running:
+            self.feedback.update(**state)
+        else:
+            self.led_buzzer(**state)
 
     def red_on(self):
-        self.led_buzzer(red=True)
+        self.set_leds(red=True)
 
     def red_off(self):
-        self.led_buzzer(red=False)
+        self.set_leds(red=False)
 
     def green_on(self):
-        self.led_buzzer(green=True)
+        self.set_leds(green=True)
 
     def green_off(self):
-        self.led_buzzer(green=False)
+        self.set_leds(green=False)
 
     def leds_off(self):
-        self.led_buzzer(red=False, green=False)
+        self.set_leds(red=False, green=False)
 
     def denied(self):
-        self.led_buzzer(
+        self.set_leds(
             red=[True, False, False],
             green=[True, True, False],
             blink=[500, 300, 3],
@@ -350,20 +1359,26 @@ class AcsReader(PcscReader):
         )
 
 
-    def send_to_pn532(self, apdu):
-        apdu = APDU(0xff, 0, 0, data=apdu)
-        resp, sw1, sw2 = self.send(apdu)
+    def send_to_pn532(self, apdu, deadline=None):
+        # If anything fails, the whole exchange has to be retried
+        return self.with_deadline(deadline, self.recovery.call, self.exchange_with_pn532, apdu)
 
-        if sw1 != 0x61:
-            raise ReaderException('Error communicating with PN532: %02x%02x' % (sw1, sw2))
+    def exchange_with_pn532(self, apdu):
+        # Hold the lock so nothing gets between the command and GET RESPONSE
+        with self.lock, self.atomic():
+            apdu = APDU(0xff, 0, 0, data=apdu)
+            resp, sw1, sw2 = self.send(apdu)
 
-        apdu = APDU(0xff, 0xc0, lc=sw2)
-        resp, sw1, sw2 = self.send(apdu)
+            if sw1 != 0x61:
+                raise ReaderException('Error communicating with PN532: %02x%02x' % (sw1, sw2))
+
+            apdu = APDU(0xff, 0xc0, lc=sw2)
+            resp, sw1, sw2 = self.send(apdu)
 
         return resp, sw1, sw2
 
     def send_to_sam(self, p1, p2, lc):
-        if (self.atr.TS, self.atr.T0) == (0x3b, 0):
+        if not self.capabilities['sam']:
             raise SAMException('SAM not reported present')
 
         resp, sw1, sw2 = self.send(APDU(0x80, 0x14, p1, p2, lc))
@@ -385,6 +1400,314 @@ class AcsReader(PcscReader):
         return toASCIIString(os), rest
 
 
+class TagTracker(object):
+    """
+    Keeps Tag objects (and their EMV state) alive while their cards stay in the field.
+
+    Each tag's presence is checked with a command or two, without losing
+    its state (see Pn532.tag_present), which is much cheaper than a full
+    anticollision. We only rescan when
+    that fails, and tags that turn up again in the scan (by UID and ATS)
+    are still the same objects.
+    """
+    def __init__(self, pn532):
+        self.pn532 = pn532
+        self.tags = []
+
+    def forget(self):
+        self.tags = []
+
+    def key(self, tag):
+        return tag.uid, tuple(tag.ats or [])
+
+    def present(self):
+        if not self.tags:
+            return False
+
+        try:
+            return self.pn532.tags_present(self.tags)
+        except (PN532Exception, CardResetException):
+            return False
+
+    def scan(self):
+        try:
+            found = self.pn532.scan()
+        except NoCardException:
+            self.tags = []
+            raise
+
+        return self.update(found)
+
+    def update(self, found):
+        # Tags from a new scan, swapped for the ones we already had where they match
+        known = dict((self.key(tag), tag) for tag in self.tags)
+        tags = []
+        for tag in found:
+            old = known.get(self.key(tag))
+            if old is not None:
+                # The logical ID may have changed, and the card's been reactivated
+                old.id = tag.id
+                old.reset()
+                if old.id in self.pn532.pending_psl:
+                    self.pn532.pending_psl[old.id] = old
+                tag = old
+            tags.append(tag)
+
+        self.tags = tags
+        return list(tags)
+
+    def current(self):
+        if self.present():
+            return list(self.tags)
+        return self.scan()
+
+
+class PollScheduler(object):
+    """
+    Decides how often Pn532.poll polls, and when the RF field goes off.
+
+    After a card's been seen, we poll every active_period with the field
+    left on. Once things go quiet, the period backs off until the field is
+    on for no more than the duty fraction of the time, but never beyond
+    the idle latency target. Gaps of at least min_rf_off are spent with the
+    field off, and the field counts as on for any gap it isn't.
+
+    stats() reports the duty cycle and detection latency actually achieved.
+    Latency is estimated from the gap before the poll that found a card,
+    as the card could have turned up at any point in it.
+    """
+    def __init__(self, active_period=0.05, latency=0.5, duty=0.1, active_window=5.0,
+                 backoff=1.5, min_rf_off=0.05, history=100):
+        self.active_period = active_period
+        self.latency = latency
+        self.duty = duty
+        self.active_window = active_window
+        self.backoff = backoff
+        self.min_rf_off = min_rf_off
+        self.history = history
+
+        self.period = active_period
+        self.last_seen = None
+        self.last_end = None
+        self.last_on = 0
+        self.on_time = 0
+        self.total_time = 0
+        self.polls = 0
+        self.detections = 0
+        self.latencies = []
+
+    def active(self, now):
+        return self.last_seen is not None and now - self.last_seen < self.active_window
+
+    def idle_period(self):
+        # Long enough to meet the duty target, if the latency target allows
+        period = max(self.active_period, self.last_on / self.duty)
+        return min(period, self.latency)
+
+    def next_poll(self):
+        now = time.time()
+        if self.active(now):
+            self.period = self.active_period
+
+        if self.last_end is None:
+            return 0, False
+
+        wait = max(0, self.period - (now - self.last_end))
+        rf_off = not self.active(now) and wait >= self.min_rf_off
+        return wait, rf_off
+
+    def record(self, start, end, found, arrived=0, rf_since=None):
+        # rf_since is when the field was switched on for this poll.
+        # Otherwise it's been on since the last one
+        on = end - start
+        if rf_since is None:
+            rf_since = start if self.last_end is None else self.last_end
+        self.polls += 1
+        self.on_time += end - rf_since
+        self.last_on = on
+
+        if self.last_end is None:
+            gap = 0
+            self.total_time += on
+        else:
+            gap = start - self.last_end
+            self.total_time += end - self.last_end
+
+        if arrived:
+            self.detections += arrived
+            self.latencies.append(gap / 2 + on)
+            del self.latencies[:-self.history]
+
+        if found:
+            self.last_seen = end
+        elif not self.active(end):
+            self.period = min(self.period * self.backoff, self.idle_period())
+
+        self.last_end = end
+
+    def stats(self):
+        latencies = self.latencies or [0]
+        return dict(
+            period = self.period,
+            polls = self.polls,
+            detections = self.detections,
+            duty = self.on_time / self.total_time if self.total_time else 1.0,
+            latency_mean = sum(latencies) / len(latencies),
+            latency_max = max(latencies),
+        )
+
+
+class RadioTuner(object):
+    """
+    Adjusts the PN532's retries and timeout to suit the site.
+
+    Pn532 reports every scan and InDataExchange here. After each window of
+    observations, the scan miss rate and exchange failure rate are compared
+    with the high and low thresholds: noisy sites get another retry, quiet
+    ones lose one, always within the bounds given. The tag response timeout
+    follows the observed per-frame latency, with some margin.
+
+    A scan only counts as a miss if a card was found within presence
+    seconds before it, so an empty field doesn't count against the reader.
+
+    Changes are written into the reader's radio_config, so they survive a
+    reopen. settings() and decisions show what's been done and why.
+    """
+    # RFConfiguration items
+    TIMEOUTS = 0x02
+    COM_RETRIES = 0x04
+    RETRIES = 0x05
+
+    def __init__(self, reader, activation=(0, 4), com=(0, 3), timeout=(0x07, 0x0d),
+                 window=20, high=0.2, low=0.05, margin=2.0, presence=1.0, history=50):
+        self.reader = reader
+        self.activation_bounds = activation
+        self.com_bounds = com
+        self.timeout_bounds = timeout
+        self.window = window
+        self.high = high
+        self.low = low
+        self.margin = margin
+        self.presence = presence
+        self.history = history
+
+        # Start from whatever the reader's configured with (or the PN532 defaults)
+        config = reader.radio_config
+        retries = list(config.get(self.RETRIES, [0xff, 0x01, 0xff]))
+        self.activation = self.clamp(retries[2], activation)
+        self.com = self.clamp(config.get(self.COM_RETRIES, [0])[0], com)
+        self.timeout = self.clamp(config.get(self.TIMEOUTS, [0x00, 0x0b, 0x0a])[2], timeout)
+
+        self.last_hit = None
+        self.scans = []
+        self.exchanges = []
+        self.latencies = []
+        self.decisions = []
+
+    def clamp(self, value, bounds):
+        low, high = bounds
+        return max(low, min(value, high))
+
+    def timeout_seconds(self, n):
+        # fRetryTimeout n is 100us * 2**(n-1)
+        return 100e-6 * 2 ** (n - 1)
+
+    def rate(self, outcomes):
+        return sum(outcomes) / float(len(outcomes)) if outcomes else 0.0
+
+    def record_scan(self, found, when=None):
+        if when is None:
+            when = time.time()
+
+        if found:
+            self.last_hit = when
+            self.scans.append(False)
+        elif self.last_hit is not None and when - self.last_hit < self.presence:
+            self.scans.append(True)
+
+        if len(self.scans) >= self.window:
+            rate = self.rate(self.scans)
+            self.scans = []
+            self.activation = self.adjust(
+                self.activation, self.activation_bounds, rate, 'scan miss rate',
+                self.RETRIES, lambda n: self.retries()[:2] + [n])
+
+    def record_exchange(self, ok, latency=None):
+        self.exchanges.append(not ok)
+        if ok and latency is not None:
+            self.latencies.append(latency)
+
+        if len(self.exchanges) >= self.window:
+            rate = self.rate(self.exchanges)
+            self.exchanges = []
+            self.com = self.adjust(
+                self.com, self.com_bounds, rate, 'exchange failure rate',
+                self.COM_RETRIES, lambda n: [n])
+
+        if len(self.latencies) >= self.window:
+            latencies = sorted(self.latencies)
+            self.latencies = []
+            self.tune_timeout(latencies[int(len(latencies) * 0.9)])
+
+    def retries(self):
+        return list(self.reader.radio_config.get(self.RETRIES, [0xff, 0x01, 0xff]))
+
+    def adjust(self, value, bounds, rate, what, item, data):
+        if rate > self.high:
+            new = self.clamp(value + 1, bounds)
+        elif rate < self.low:
+            new = self.clamp(value - 1, bounds)
+        else:
+            return value
+
+        if new != value:
+            self.set(item, data(new), '%s %.2f' % (what, rate))
+        return new
+
+    def tune_timeout(self, latency):
+        # Latency is measured from the host, so includes USB time and errs long
+        needed = latency * self.margin
+        low, high = self.timeout_bounds
+        new = low
+        while new < high and self.timeout_seconds(new) < needed:
+            new += 1
+
+        if new != self.timeout:
+            timeouts = list(self.reader.radio_config.get(self.TIMEOUTS, [0x00, 0x0b, 0x0a]))
+            timeouts[2] = new
+            self.set(self.TIMEOUTS, timeouts, '90th percentile latency %.1fms' % (latency * 1000))
+            self.timeout = new
+
+    def set(self, item, data, reason):
+        old = self.reader.radio_config.get(item)
+        self.reader.radio_config[item] = data
+
+        applied = True
+        try:
+            self.reader.pn532.set_radio(item, data)
+        except SmartcardException:
+            # It'll go out on the next open anyway
+            applied = False
+
+        self.decisions.append(dict(
+            time = time.time(),
+            item = item,
+            old = old,
+            new = data,
+            reason = reason,
+            applied = applied,
+        ))
+        del self.decisions[:-self.history]
+
+    def settings(self):
+        return dict(
+            activation_retries = self.activation,
+            com_retries = self.com,
+            timeout_ms = self.timeout_seconds(self.timeout) * 1000,
+            radio_config = dict(self.reader.radio_config),
+        )
+
+
 class Pn532(object):
     BITRATES = [106, 212, 424]
     MODULATIONS = {
@@ -394,17 +1717,37 @@ class Pn532(object):
         0x10: 'FeliCa/ISO18092 passive 212/424kbps',
     }
     ENCODINGS = ['Type A', 'FeliCa 212kbps', 'FeliCa 424kbps', 'Type B', 'Type 1']
+    # InAutoPoll target type for each of the above
+    SCAN_TYPES = [0x00, 0x11, 0x12, 0x23, 0x04]
+    AUTOPOLL_TYPES = [0x20, 0x23, 0x4, 0x10, 0x11, 0x12]
     FIRMWARE_FEATURES = ['Type A', 'Type B', 'ISO18092']
 
     def __init__(self, reader):
         self.reader = reader
-
-    def send(self, cc, data=None):
+        # Logical number of the target we last talked to
+        self.selected = None
+        # Whether the PN532 sends RATS to ISO14443-4 cards (see set_params)
+        self.rats = True
+        # Try to raise the bitrate before the first exchange with each target
+        self.negotiate = True
+        # Logical number to Tag, for targets we haven't negotiated with yet
+        self.pending_psl = {}
+        # Logical number to (family, Tag) for targets above 106kbps
+        self.target_bitrates = {}
+        # Bitrates (to tag, from tag) that worked for each card family
+        self.family_bitrates = {}
+        self.buffer = bytearray()
+        # Frames in the last InDataExchange, for per-frame latency
+        self.frames = 0
+        # RadioTuner to report scans and exchanges to (see AcsReader.tune_radio)
+        self.tuner = None
+
+    def send(self, cc, data=None, deadline=None):
         if data is None:
             data = []
 
         tfi = 0xd4 # host to controller
-        resp, sw1, sw2 = self.reader.send_to_pn532([tfi, cc] + data)
+        resp, sw1, sw2 = self.reader.send_to_pn532([tfi, cc] + data, deadline=deadline)
         tfi2, cc2 = resp[:2]
         if (tfi2, cc2) != (0xd5, cc + 1):
             raise PN532Exception('Error returned: %02x%02x' % (tfi2, cc2))
@@ -416,6 +1759,75 @@ class Pn532(object):
         resp = self.send(0, [test] + params)
         return resp
 
+    def card_present(self):
+        # InDiagnose presence test, for the current ISO14443-4 target
+        resp = self.test(0x06, [])
+        return resp[:1] == [0]
+
+    # Status when the target didn't answer at all
+    TIMEOUT = 0x01
+    # Statuses that suggest the card can't keep up with a faster bitrate:
+    # CRC, parity, framing, bit collision, RF buffer overflow, RF protocol
+    # and ISO14443-4 block format errors
+    BITRATE_ERRORS = [0x02, 0x03, 0x05, 0x06, 0x09, 0x0b, 0x13]
+
+    def listed_targets(self):
+        # Logical IDs the PN532 still has activated. It drops a target
+        # once an exchange with it fails
+        return [target['logical_id'] for target in self.status()['tags']]
+
+    def tags_present(self, tags):
+        # The current target goes first, as it doesn't need selecting
+        listed = None
+        for tag in sorted(tags, key=lambda tag: tag.id != (self.selected or 1)):
+            if not tag.iso14443_4 and tag.protocol == 'Type A' and listed is None:
+                listed = self.listed_targets()
+            if not self.tag_present(tag, listed):
+                return False
+        return True
+
+    def tag_present(self, tag, listed=None):
+        """
+        Whether an activated target is still in the field, in one or two
+        commands, without losing any state it has.
+
+        ISO14443-4 cards get the InDiagnose presence test, which is for the
+        current target, so others have to be selected first. Other Type A
+        tags have to be listed by GetGeneralStatus (pass listed to share
+        one between several tags). Ultralight and unauthenticated Classic
+        tags then get a READ of page or block 0, which InDataExchange sends
+        to the right target anyway. Classic NAKs it, which still means it's
+        there. While a Classic sector is authenticated, the listing is all
+        we go on, as a NAK would lose the authentication. Anything else
+        needs a scan.
+        """
+        if tag.iso14443_4:
+            if tag.id != (self.selected or 1):
+                self.select_tag(tag.id)
+            return self.card_present()
+
+        if tag.protocol != 'Type A':
+            return False
+
+        if listed is None:
+            listed = self.listed_targets()
+        if tag.id not in listed:
+            return False
+
+        if getattr(tag._memory, 'authenticated', None) is not None:
+            return True
+
+        try:
+            self.exchange(tag.id, [0x30, 0])
+        except TagStatusException as e:
+            if e.status & 0x3f == self.TIMEOUT:
+                return False
+            # The NAK sent it back to idle. Nothing was authenticated,
+            # so waking it up again is all it needs
+            self.select_tag(tag.id)
+        self.selected = tag.id
+        return True
+
     def firmware(self):
         resp = self.send(0x2)
         ic, ver, rev, support = resp
@@ -434,23 +1846,17 @@ class Pn532(object):
 
     def status(self):
         resp = self.send(0x4)
-        r = iter(resp)
-
-        err = next(r)
-        field = next(r)
-        nbtg = next(r)
+        err, field, status_targets, sam = self.decode(targets.decode_status, resp)
 
         tags = []
-        for tag in range(nbtg):
+        for logical_id, rx, tx, modulation in status_targets:
             tags.append(dict(
-                logical_id = next(r),
-                rx_kbps = self.BITRATES[next(r)],
-                tx_kbps = self.BITRATES[next(r)],
-                modulation = self.MODULATIONS[next(r)],
+                logical_id = logical_id,
+                rx_kbps = self.BITRATES[rx],
+                tx_kbps = self.BITRATES[tx],
+                modulation = self.MODULATIONS[modulation],
             ))
 
-        sam = next(r)
-
         status = dict(
             error = err,
             field = bool(field),
@@ -459,7 +1865,101 @@ class Pn532(object):
 
         return status
 
-    # TODO: registers and GPIO
+    # Registers and GPIO
+    #
+    # Registers can be given by address, name or field (see registers.py).
+    # Reads and writes are batched into as few frames as possible.
+
+    REGISTERS = REGISTERS
+    MAX_READ = 125  # 2 bytes per address
+    MAX_WRITE = 83  # 3 bytes per address and value
+
+    def read_registers(self, keys):
+        addresses = [self.REGISTERS.address(key) for key in keys]
+        values = []
+        for i in range(0, len(addresses), self.MAX_READ):
+            data = []
+            for address in addresses[i:i + self.MAX_READ]:
+                data += [address >> 8, address & 0xff]
+            values += self.send(0x06, data)
+
+        return OrderedDict(zip(addresses, values))
+
+    def read_register(self, key):
+        address, field = self.REGISTERS.resolve(key)
+        value = self.read_registers([address])[address]
+        if field is not None:
+            return self.REGISTERS.register(address).get(value, field)
+        return value
+
+    def write_registers(self, values):
+        # values is a dict or list of (address or name, value)
+        if isinstance(values, dict):
+            values = list(values.items())
+
+        for i in range(0, len(values), self.MAX_WRITE):
+            data = []
+            for key, value in values[i:i + self.MAX_WRITE]:
+                address = self.REGISTERS.address(key)
+                data += [address >> 8, address & 0xff, value]
+            self.send(0x08, data)
+
+    def apply_profile(self, profile):
+        """
+        Set a whole tuning profile, e.g.
+
+            pn532.apply_profile({'RFCfg.RxGain': 7, 'GsNOn': 0xff, 'CWGsP': 0x3f})
+
+        Registers that only have some fields set are read first (in one frame),
+        then everything is written in one frame, so the profile goes in together.
+        """
+        whole = OrderedDict()
+        fields = OrderedDict()
+        for key, value in profile.items():
+            address, field = self.REGISTERS.resolve(key)
+            if field is None:
+                whole[address] = value
+            else:
+                fields.setdefault(address, []).append((field, value))
+
+        partial = [address for address in fields if address not in whole]
+        current = self.read_registers(partial) if partial else {}
+
+        values = OrderedDict(whole)
+        for address, changes in fields.items():
+            register = self.REGISTERS.register(address)
+            value = values.get(address, current.get(address))
+            for field, fieldvalue in changes:
+                value = register.set(value, field, fieldvalue)
+            values[address] = value
+
+        with self.reader.transaction():
+            self.write_registers(list(values.items()))
+        return values
+
+    def read_gpio(self):
+        p3, p7, io = self.send(0x0c)[:3]
+        return dict(
+            p3 = p3,
+            p7 = p7,
+            i0 = bool(io & 1),
+            i1 = bool(io & 2),
+        )
+
+    def write_gpio(self, p3=None, p7=None):
+        # The top bit says whether to change each port
+        data = [
+            0x80 | p3 if p3 is not None else 0,
+            0x80 | p7 if p7 is not None else 0,
+        ]
+        self.send(0x0e, data)
+
+    def set_gpio_pin(self, port, pin, value):
+        # Only touches the one pin, but costs a ReadGPIO as well
+        gpio = self.read_gpio()
+        current = gpio[port]
+        current = current | (1 << pin) if value else current & ~(1 << pin)
+        self.write_gpio(**{port: current & 0x7f})
 
     def set_params(self, nad=False, cid=False, atr_res=True, rats=True, picc=True, nopreamble=False):
         flags = 0
@@ -470,7 +1970,9 @@ class Pn532(object):
         flags |= 0x20 if picc else 0
         flags |= 0x40 if nopreamble else 0
 
-        return self.send(0x12, [flags])
+        resp = self.send(0x12, [flags])
+        self.rats = rats
+        return resp
 
     def shutdown(self, wakeup, interrupt=None):
         args = [wakeup]
@@ -491,17 +1993,177 @@ class Pn532(object):
         return self.set_radio(5, [atr_req, psl_req, passive])
 
 
-    def send_to_tag(self, tag, data):
-        resp = self.send(0x40, [tag] + list(data))
-        if resp[0] != 0:
-            raise PN532Exception('Unexpected status %02x' % resp[0])
+    def send_to_tag(self, tag, data, deadline=None):
+        if tag != self.selected and self.selected is not None:
+            # Switch without going through anticollision again
+            self.select_tag(tag)
+
+        if tag in self.pending_psl:
+            self.negotiate_bitrate(self.pending_psl.pop(tag))
+
+        start = time.time()
+        try:
+            resp = self.exchange(tag, data, deadline)
+            self.record_exchange(True, start)
+
+        except PN532Exception as e:
+            self.record_exchange(False, start)
+            if tag not in self.target_bitrates:
+                raise
+            if not isinstance(e, TagStatusException) or e.status & 0x3f not in self.BITRATE_ERRORS:
+                # Nothing to do with the bitrate (e.g. a timeout, or a NAK)
+                raise
+
+            # Try again at 106kbps, and don't go faster with this sort of card again
+            family, slow_tag = self.target_bitrates.pop(tag)
+            self.family_bitrates[family] = (106, 106)
+            self.psl(tag, 106, 106)
+            slow_tag.bitrate = (106, 106)
+            resp = self.exchange(tag, data, deadline)
+
+        self.selected = tag
+        return resp
+
+    # InDataExchange
+    MAX_CHUNK = 252  # Lc is one byte, and includes D4 40 Tg
+    MORE_INFORMATION = 0x40
+
+    def exchange(self, tag, data, deadline=None):
+        data = list(data)
+        self.frames = 1
+
+        # Anything too big for one frame goes in chunks with MI set on all but the last
+        while len(data) > self.MAX_CHUNK:
+            resp = self.send(0x40, [tag | self.MORE_INFORMATION] + data[:self.MAX_CHUNK], deadline=deadline)
+            self.check_status(resp)
+            del data[:self.MAX_CHUNK]
+            self.frames += 1
+
+        resp = self.send(0x40, [tag] + data, deadline=deadline)
+        status = self.check_status(resp)
+
+        # Reuse the buffer, as a chained response can be several KB
+        buf = self.buffer
+        del buf[:]
+        buf.extend(resp[1:])
+
+        while status & self.MORE_INFORMATION:
+            # Ask for the rest
+            resp = self.send(0x40, [tag], deadline=deadline)
+            status = self.check_status(resp)
+            buf.extend(resp[1:])
+            self.frames += 1
+
+        return list(buf)
+
+    def record_exchange(self, ok, start):
+        if self.tuner is not None:
+            latency = (time.time() - start) / max(1, self.frames)
+            self.tuner.record_exchange(ok, latency)
+
+    def record_scan(self, found):
+        if self.tuner is not None:
+            self.tuner.record_scan(found)
+
+    def check_status(self, resp):
+        status = resp[0]
+        if status & 0x3f:
+            raise TagStatusException(status)
+        return status
+
+    def communicate_thru(self, tag, data, deadline=None):
+        # InCommunicateThru, for tag commands the PN532 doesn't know about
+        # (e.g. Ultralight FAST_READ). It goes to the selected target.
+        if tag != self.selected:
+            self.select_tag(tag)
+
+        resp = self.send(0x42, list(data), deadline=deadline)
+        self.check_status(resp)
         return resp[1:]
 
+    def psl(self, tag, to_tag=106, from_tag=106):
+        # InPSL, to change the bitrate of an activated target
+        resp = self.send(0x4e, [tag, self.BITRATES.index(to_tag), self.BITRATES.index(from_tag)])
+        if resp[0] != 0:
+            raise PN532Exception('Error changing bitrate: %02x' % resp[0])
+
+    def card_family(self, tag):
+        return tag.protocol, tag.type, tuple(tag.ats or [])
+
+    # From TA(1) in the ATS
+    TA_TO_TAG = [(0x02, 424), (0x01, 212)]
+    TA_FROM_TAG = [(0x20, 424), (0x10, 212)]
+
+    def best_bitrate(self, tag):
+        # Only ISO14443-4A targets can have their bitrate changed with PSL
+        if tag.protocol != 'Type A' or not tag.ats:
+            return 106, 106
+
+        t0 = tag.ats[0]
+        if not t0 & 0x10 or len(tag.ats) < 2:
+            # No TA(1), so 106kbps only
+            return 106, 106
+
+        ta = tag.ats[1]
+        to_tag = max([106] + [rate for bit, rate in self.TA_TO_TAG if ta & bit])
+        from_tag = max([106] + [rate for bit, rate in self.TA_FROM_TAG if ta & bit])
+        if ta & 0x80:
+            # Has to be the same in both directions
+            to_tag = from_tag = min(to_tag, from_tag)
+
+        return to_tag, from_tag
+
+    def negotiate_bitrate(self, tag):
+        family = self.card_family(tag)
+        bitrates = self.family_bitrates.get(family)
+        if bitrates is None:
+            bitrates = self.best_bitrate(tag)
+
+        if bitrates != (106, 106):
+            try:
+                self.psl(tag.id, *bitrates)
+            except PN532Exception:
+                bitrates = 106, 106
+            else:
+                self.target_bitrates[tag.id] = family, tag
+
+        self.family_bitrates[family] = bitrates
+        tag.bitrate = bitrates
+        return bitrates
+
+    def forget_targets(self):
+        # After the PN532's been reset, nothing's activated
+        self.selected = None
+        self.pending_psl = {}
+        self.target_bitrates = {}
+
+    def target_command(self, cc, tag, name):
+        resp = self.send(cc, [tag])
+        if resp[0] != 0:
+            raise PN532Exception('Error %s target %s: %02x' % (name, tag, resp[0]))
+
+    def select_tag(self, tag):
+        self.target_command(0x54, tag, 'selecting')
+        self.selected = tag
+
+    # For these, 0 means all targets
+
+    def deselect_tag(self, tag=0):
+        # The target keeps its logical number, so it can be selected again
+        self.target_command(0x44, tag, 'deselecting')
+        if tag in (0, self.selected):
+            self.selected = None
+
+    def release_tag(self, tag=0):
+        self.target_command(0x52, tag, 'releasing')
+        if tag in (0, self.selected):
+            self.selected = None
+
     def halt_tag(self):
-        resp = self.send(0x44, [1])
+        self.deselect_tag(1)
 
-    def scan(self, max_tags=1, encoding='Type A', data=None):
-        # TODO: try max_tags=2
+    def scan(self, max_tags=2, encoding='Type A', data=None):
+        # The PN532 can activate at most two targets at once
         if data is None:
             data = []
             if encoding == 'Type B':
@@ -512,86 +2174,148 @@ class Pn532(object):
 
         brty = self.ENCODINGS.index(encoding)
         resp = self.send(0x4a, [max_tags, brty] + data)
+        self.record_scan(bool(resp[0]))
 
-        r = iter(resp)
-        nbtg = next(r)
-        if not nbtg:
+        if not resp[0]:
             raise NoCardException('No cards found', hresult=-1)
 
-        tags = []
-        if brty == 0:
-            for i in range(nbtg):
-                tagtype = 0x10
-                tags.append(self.parse_tag(tagtype, r))
-
-        else:
-            raise NotImplementedError()
+        # Whichever we talk to first becomes the current target
+        self.selected = None
 
-        return tags
+        # InListPassiveTarget gives the same target data as InAutoPoll
+        found = self.decode(targets.decode_list, resp, self.SCAN_TYPES[brty], self.rats)
+        return self.activated([self.make_tag(target) for target in found])
 
-    def autoscan(self, polls=1, ms=150, types=[0x20, 0x23, 0x4, 0x10, 0x11, 0x12]):
+    def autoscan(self, polls=1, ms=150, types=None):
         if polls is None:
             polls = 0xff
-        period = ms / 150
+        if types is None:
+            types = self.AUTOPOLL_TYPES
+        period = max(1, ms // 150)
 
         resp = self.send(0x60, [polls, period] + types)
+        self.record_scan(bool(resp[0]))
 
-        r = iter(resp)
-        nbtg = next(r)
-        if not nbtg:
+        if not resp[0]:
             raise NoCardException('No cards found', hresult=-1)
 
-        tags = []
-        for i in range(nbtg):
-            tagtype = next(r)
-            length = next(r)
+        self.selected = None
 
-            taginfo = [next(r) for i in range(length)]
-            tags.append(self.parse_tag(tagtype, iter(taginfo)))
+        found = self.decode(targets.decode_autopoll, resp, self.rats)
+        return self.activated([self.make_tag(target) for target in found])
 
+    def activated(self, tags):
+        # Every target is back at 106kbps after activation
+        self.target_bitrates = {}
+        self.pending_psl = {}
+        if self.negotiate:
+            for tag in tags:
+                self.pending_psl[tag.id] = tag
         return tags
 
-    # Move to tag.py
-    def parse_tag(self, tagtype, r):
-        target = next(r)
-
-        if tagtype in (0x10, 0x20):
-            sens_res = (next(r) << 8) + next(r)
-            sel_res = next(r)
-
-            uidlen = next(r)
-            uid = ''.join('%02x' % next(r) for i in range(uidlen))
-
-            tag = Tag(self, target, sens_res, sel_res)
-            tag.uid = uid
-
-            if tagtype == 0x20:
-                atslen = next(r)
-                ats = [next(r) for i in range(atslen - 1)]
-                tag.ats = ats
+    def decode(self, decoder, *args):
+        try:
+            return decoder(*args)
+        except ValueError as e:
+            raise PN532Exception(str(e))
+
+    def poll(self, scheduler=None, ms=150, types=None):
+        """
+        Poll forever, yielding ('arrived', tag) and ('left', tag) events.
+
+        The scheduler decides how long to wait between polls, and whether
+        to turn the field off while waiting. A card that stays in the field
+        is only reported once, and keeps the same Tag object (matched as in
+        TagTracker, whose tags are the reader's).
+        """
+        if scheduler is None:
+            scheduler = PollScheduler()
+
+        tracker = getattr(self.reader, 'tracker', None)
+        if tracker is None or tracker.pn532 is not self:
+            tracker = TagTracker(self)
+
+        field_on = True
+        try:
+            while True:
+                wait, rf_off = scheduler.next_poll()
+                if rf_off and field_on:
+                    self.power_off()
+                    field_on = False
+
+                if wait > 0:
+                    time.sleep(wait)
+
+                rf_since = None
+                if not field_on:
+                    rf_since = time.time()
+                    self.power_on()
+                    field_on = True
+
+                start = time.time()
+                try:
+                    tags = self.autoscan(polls=1, ms=ms, types=types)
+                except NoCardException:
+                    tags = []
+                end = time.time()
+
+                present = OrderedDict((tracker.key(tag), tag) for tag in tracker.tags)
+                found = OrderedDict((tracker.key(tag), tag) for tag in tracker.update(tags))
+                arrived = [key for key in found if key not in present]
+                left = [key for key in present if key not in found]
+                scheduler.record(start, end, bool(found), len(arrived), rf_since)
+
+                for key in left:
+                    yield 'left', present[key]
+
+                for key in arrived:
+                    yield 'arrived', found[key]
+
+        finally:
+            if not field_on:
+                self.power_on()
+
+    def make_tag(self, target):
+        tagtype = target.type
+
+        if tagtype in (0x00, 0x10, 0x20):
+            tag = Tag(self, target.logical_id, target.sens_res, target.sel_res)
+            tag.protocol = 'Type A'
+            if target.ats is not None:
+                tag.ats = list(target.ats)
+                tag.iso14443_4 = True
 
         elif tagtype == 0x23:
-            atqb = [next(r) for i in range(12)]
-
-            arlen = next(r)
-            ar = [next(r) for i in range(arlen)]
-
-        elif tagtype == 0x11:
-            prlen = next(r)
-            pol_res = [next(r) for i in range(prlen - 1)]
-            p = iter(pol_res)
-
-            resp_code = next(p)
-            uid = ''.join('%02x' % next(p) for i in range(8))
-            print(uid)
+            tag = Tag(self, target.logical_id, None, None)
+            tag.protocol = 'Type B'
+            tag.type = 'ISO14443-4B'
+            tag.atqb = list(target.atqb)
+            tag.app_data = tag.atqb[5:9]
+            tag.protocol_info = tag.atqb[9:12]
+            tag.attrib_res = list(target.attrib_res)
+            tag.iso14443_4 = True
+
+        elif tagtype in (0x11, 0x12):
+            tag = Tag(self, target.logical_id, None, None)
+            tag.protocol = 'FeliCa'
+            tag.type = 'FeliCa %skbps' % (212 if tagtype == 0x11 else 424)
+            tag.pad = list(target.pad)
+            tag.system_code = target.system_code
 
         elif tagtype == 0x4:
-            atqa = (next(r) << 8) + next(r)
-            uid = ''.join('%02x' % next(r) for i in range(4))
+            tag = Tag(self, target.logical_id, target.sens_res, None)
+            tag.protocol = 'Jewel'
+            tag.type = 'Jewel'
 
+        else:
+            raise PN532Exception('Unknown target type %02x' % tagtype)
+
+        tag.uid = target.uid.hex()
         return tag
 
 
+registry = ReaderRegistry()
+
 from .tag import Tag
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Responses that don't change for a given card (GPO results, AFL records),
+kept on disk so later reads can skip the commands that produced them. GPO in
+particular increments the ATC, which cards only have so many of.
+
+The store is an sqlite database, which does the locking, so several
+processes can share it. It lives in a directory only this user can get into
+(see common.private_dir), and is created readable by nobody else. Cards are
+indexed by an HMAC of whatever identifies them, so the index doesn't give
+away card numbers. The secret for that is passed in, or kept in a separate
+file next to the database, so a copy of the database alone can't be
+matched against known cards. Entries older than retention seconds are
+ignored, and purged when the store is opened.
+
+No pyscard in here.
+"""
+
+import os
+import time
+import hmac
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from .common import private_dir
+
+def open_private(path, flags):
+    # Refuses symlinks and files someone else made (e.g. planted beforehand)
+    fd = os.open(path, flags | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    try:
+        if hasattr(os, 'getuid'):
+            st = os.fstat(fd)
+            if st.st_uid != os.getuid():
+                raise OSError('%s belongs to another user' % path)
+            if st.st_mode & 0o077:
+                os.fchmod(fd, 0o600)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+class CardStore(object):
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS responses ('
+        '  card TEXT, kind TEXT, key TEXT, data BLOB, stored REAL,'
+        '  PRIMARY KEY (card, kind, key))',
+        'CREATE INDEX IF NOT EXISTS responses_stored ON responses (stored)',
+    ]
+
+    def __init__(self, path=None, retention=30 * 24 * 3600, timeout=5.0, secret=None):
+        if path is None:
+            path = os.path.join(private_dir(), 'cards.db')
+        self.path = path
+        self.retention = retention
+        self.timeout = timeout
+        # sqlite connections can't be shared between threads
+        self.local = threading.local()
+        self.purged = False
+        # Read from path + '.key' (or made up) if not given
+        self._secret = secret
+
+    def db(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # sqlite gives the -wal and -shm files the same permissions
+            os.close(open_private(self.path, os.O_RDWR | os.O_CREAT))
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # Readers don't block the writer, or each other
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self.local.conn = conn
+
+            if not self.purged:
+                self.purged = True
+                self.expire()
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def secret(self):
+        if self._secret is None:
+            self._secret = self.load_secret(self.path + '.key')
+        return self._secret
+
+    def load_secret(self, path):
+        try:
+            fd = open_private(path, os.O_RDONLY)
+        except FileNotFoundError:
+            pass
+        else:
+            with os.fdopen(fd, 'rb') as f:
+                return f.read()
+
+        # Written in full before it appears, and whichever process gets
+        # there first decides
+        fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+        try:
+            secret = os.urandom(32)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secret)
+            try:
+                os.link(temp, path)
+            except FileExistsError:
+                return self.load_secret(path)
+            return secret
+        finally:
+            os.unlink(temp)
+
+    def card_key(self, *parts):
+        # parts can be strings or lists of bytes (e.g. a UID, or PAN and PSN)
+        text = '|'.join(part if isinstance(part, str) else bytes(bytearray(part)).hex() for part in parts)
+        return hmac.new(self.secret(), text.encode(), hashlib.sha256).hexdigest()
+
+    def get(self, card, kind, key):
+        row = self.db().execute(
+            'SELECT data FROM responses WHERE card = ? AND kind = ? AND key = ? AND stored > ?',
+            (card, kind, key, time.time() - self.retention)).fetchone()
+        if row is None:
+            return None
+        return list(bytearray(row[0]))
+
+    def put(self, card, kind, key, data):
+        self.db().execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+            (card, kind, key, bytes(bytearray(data)), time.time()))
+
+    def forget(self, card):
+        self.db().execute('DELETE FROM responses WHERE card = ?', (card,))
+
+    def expire(self):
+        cursor = self.db().execute('DELETE FROM responses WHERE stored <= ?', (time.time() - self.retention,))
+        return cursor.rowcount
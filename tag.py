@@ -1,7 +1,6 @@
 #!/usr/bin/env python
-from smartcard.util import toASCIIBytes, toHexString
 #from hashlib import sha256
-from .common import TagException
+from .common import TagException, Deadline, toASCIIBytes
 from collections import defaultdict
 
 class TagInstructionNotSupported(TagException):
@@ -39,49 +38,186 @@ class Tag(object):
         self.sens_res = sens_res
         self.sel_res = sel_res
         self.type = self.SEL_RES.get(sel_res, 'Unknown tag')
+        self.protocol = None
+        self.iso14443_4 = False
         self.uid = None
         self.ats = None
+        # Bitrates (to tag, from tag) in kbps
+        self.bitrate = (106, 106)
+        # Basic channel. Applications opened with app() get their own
         self.emv = EMV(self)
+        self.apps = {}
+        # None until we've tried MANAGE CHANNEL
+        self.channels_supported = None
+        self._memory = None
+        # See profiles.Recorder
+        self.recorders = []
+        # Logical channel to (DF name, response) for the SELECT each channel
+        # is still as it left. See EMV.select_by_df and track_selection
+        self.selections = {}
 
     def __str__(self):
         return '<%s tag (%s)>' % (self.type, self.id)
 
 
-    def send(self, apdu):
-        return self.reader.send_to_tag(self.id, apdu)
-
-    def find_unique_id(self):
+    # Memory on non-ISO tags (Mifare Ultralight and Classic)
+
+    @property
+    def memory(self):
+        if self._memory is None:
+            self._memory = mifare.for_tag(self)
+            if self._memory is None:
+                raise TagInstructionNotSupported('No memory access for %s' % self.type)
+        return self._memory
+
+    def dump_memory(self):
+        # Pages for Ultralight, sectors of blocks for Classic
+        return self.memory.dump()
+
+
+    # Switching between targets, where the reader supports it (e.g. PN532)
+
+    def select(self):
+        self.reader.select_tag(self.id)
+
+    def deselect(self):
+        self.reader.deselect_tag(self.id)
+
+    def release(self):
+        self.reader.release_tag(self.id)
+
+    def send(self, apdu, deadline=None):
+        # deadline can be a Deadline or a number of seconds
+        resp = self.reader.send_to_tag(self.id, apdu, deadline=Deadline.coerce(deadline))
+        for recorder in self.recorders:
+            recorder.record(apdu, resp)
+        if self.selections:
+            self.track_selection(list(apdu), resp)
+        return resp
+
+    def track_selection(self, apdu, resp):
+        # Whoever sent it, anything that could change a channel's selection
+        # means the next SELECT has to go to the card
+        cla, ins, p1, p2 = apdu[:4]
+        if ins == 0x70 and p1 == 0x80:
+            # MANAGE CHANNEL close
+            self.selections.pop(p2, None)
+
+        sw = tuple(resp[-2:])
+        if ins in EMV.STATE_CHANGING or (sw != (0x90, 0) and sw not in EMV.HARMLESS_ERRORS):
+            # Some cards drop the selection on errors
+            self.selections.pop(cla_channel(cla), None)
+
+    def forget_selections(self):
+        # e.g. after a command was cancelled part way through
+        self.selections = {}
+
+    def reset(self):
+        # The card's been reactivated, so nothing is selected and only the basic channel is open
+        self.selections = {}
+        self.emv.pending_gpo = None
+        self.apps = {}
+        if self._memory is not None:
+            self._memory.reset()
+
+    # Logical channels, so several applications can stay selected at once
+
+    def open_channel(self):
+        # MANAGE CHANNEL open, on the basic channel. The card picks the number
+        resp = self.emv.send(APDU(0, 0x70, 0, 0))
+        return resp[0]
+
+    def close_channel(self, channel):
+        self.emv.send(APDU(0, 0x70, 0x80, channel))
+        for aid, emv in list(self.apps.items()):
+            if emv.channel == channel:
+                del self.apps[aid]
+
+    def close_channels(self):
+        for emv in list(self.apps.values()):
+            self.close_channel(emv.channel)
+
+    def app(self, aid):
+        """
+        An EMV for the application, selected on its own logical channel.
+
+        The channel stays open, so asking again doesn't reselect. Cards
+        without logical channels get the basic channel, reselected.
+        """
+        emv = self.apps.get(tuple(aid))
+        if emv is not None:
+            return emv
+
+        if self.channels_supported is not False:
+            try:
+                channel = self.open_channel()
+            except EMVException:
+                self.channels_supported = False
+            else:
+                self.channels_supported = True
+                emv = EMV(self, channel)
+                try:
+                    emv.select_by_df(aid)
+                except EMVException:
+                    self.close_channel(channel)
+                    raise
+                self.apps[tuple(aid)] = emv
+                return emv
+
+        self.emv.select_by_df(aid)
+        return self.emv
+
+    def find_unique_id(self, profiles=None):
         # when registering a card, the caller should always
         # power cycle and try again to detect randomised IDs
 
         if self.uid == '21222324':
-
-            un = self.emv.get_data_parsed('UN')
-            digits = defaultdict(int)
-            for digit in un:
-                digits[digit] += 1
-
-            if len(digits) > 5:
-                # Assume there's enough entropy to hash safely
-                # Don't return the actual UN, as that needs to
-                # remain unpredictable
-                #return CardHashedUN(hashlib.sha256(un))
-                return CardHashedUN(' '.join('%02x' % x for x in un))
-
-            #name, sfi = self.emv.select_by_df(toASCIIBytes('1PAY.SYS.DDF01'))
-            #apps = self.emv.parse_apps(self.emv.read_record(1, sfi))
-            #priority, name, aid = apps[0]
-            #self.emv.select_by_df(aid)
-
-            # don't return cardnum because that can be used for offline fraud
-            #card = self.emv.parse_card(self.emv.read_record(1, sfi))
-            #return card['cardnum']
+            # Later taps of the same sort of card skip straight to GET DATA
+            if profiles is None:
+                profiles = PROFILES
+            return profiles.identify(self, self.discover_un, self.hashed_un)
 
         else:
             return CardUID(self.uid)
 
-
-from .emv import EMV
+    def discover_un(self):
+        # Everything sent here is recorded for the profile (see profiles.py)
+        emv = self.emv
+        try:
+            return self.hashed_un(emv.get_data('UN'))
+        except EMVException:
+            pass
+
+        # Some cards need an application selected first. Use PPSE to list apps
+        fci = emv.BER(emv.send(APDU(0, 0xa4, 4, 0, data=toASCIIBytes('2PAY.SYS.DDF01'))))['FCI']
+        apps = fci['FCI_ISSUER']['FCI_EXTRA'].getlistparsed('APP')
+        if not apps:
+            raise TagInstructionNotSupported('No applications listed')
+
+        priority, name, aid = min(apps, key=lambda app: app[0])
+        emv.select_by_df(aid)
+        return self.hashed_un(emv.get_data('UN'))
+
+    def hashed_un(self, data):
+        un = self.emv.BER(data).parsed('UN')
+        digits = defaultdict(int)
+        for digit in un:
+            digits[digit] += 1
+
+        if len(digits) > 5:
+            # Assume there's enough entropy to hash safely
+            # Don't return the actual UN, as that needs to
+            # remain unpredictable
+            #return CardHashedUN(hashlib.sha256(un))
+            return CardHashedUN(' '.join('%02x' % x for x in un))
+
+        # don't return cardnum because that can be used for offline fraud
+
+
+from .emv import EMV, EMVException
+from .apdu import APDU, cla_channel
+from .profiles import cache as PROFILES
+from . import mifare
 
 if __name__ == '__main__':
     from .rfid import Pcsc
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Decoders for the target data in PN532 responses (InListPassiveTarget,
+InAutoPoll and GetGeneralStatus).
+
+These get called on every poll, so they use precompiled structs and
+memoryview slices rather than iterating byte by byte. No pyscard in here.
+"""
+
+import struct
+
+# Tg, SENS_RES, SEL_RES, NFCIDLength
+TYPE_A = struct.Struct('>BHBB')
+# Tg, ATQB, ATTRIB_RES length
+TYPE_B = struct.Struct('>B12sB')
+# Tg, POL_RES length, response code, NFCID2t, pad
+FELICA = struct.Struct('>BBB8s8s')
+# Tg, SENS_RES, JEWELID
+JEWEL = struct.Struct('>BH4s')
+# Tg, BrRx, BrTx, modulation type
+STATUS_TARGET = struct.Struct('>BBBB')
+FELICA_SYSTEM_CODE = struct.Struct('>H')
+
+
+class Target(object):
+    # Lots of these get made, so no __dict__
+    __slots__ = [
+        'type', 'logical_id', 'sens_res', 'sel_res', 'uid', 'ats',
+        'atqb', 'attrib_res', 'pad', 'system_code',
+    ]
+
+    def __init__(self, type, logical_id):
+        self.type = type
+        self.logical_id = logical_id
+        self.sens_res = None
+        self.sel_res = None
+        self.uid = None
+        self.ats = None
+        self.atqb = None
+        self.attrib_res = None
+        self.pad = None
+        self.system_code = None
+
+    def __repr__(self):
+        return '<Target %02x (%s): %s>' % (self.type, self.logical_id, self.uid.hex())
+
+
+def decode_type_a(mv, offset, tagtype, rats):
+    tg, sens_res, sel_res, uidlen = TYPE_A.unpack_from(mv, offset)
+    offset += TYPE_A.size
+
+    target = Target(tagtype, tg)
+    target.sens_res = sens_res
+    target.sel_res = sel_res
+    target.uid = mv[offset:offset + uidlen].tobytes()
+    offset += uidlen
+
+    if tagtype == 0x00:
+        # Generic 106kbps. The PN532 sends RATS if the card says it's ISO14443-4
+        has_ats = rats and sel_res & 0x20
+    else:
+        has_ats = tagtype == 0x20
+
+    if has_ats:
+        # ATS length includes itself
+        atslen = mv[offset]
+        target.ats = mv[offset + 1:offset + atslen].tobytes()
+        offset += atslen
+
+    return target, offset
+
+def decode_type_b(mv, offset, tagtype, rats):
+    tg, atqb, arlen = TYPE_B.unpack_from(mv, offset)
+    offset += TYPE_B.size
+
+    target = Target(tagtype, tg)
+    # ATQB is 0x50, PUPI, application data and protocol info
+    target.atqb = atqb
+    target.uid = atqb[1:5]
+    target.attrib_res = mv[offset:offset + arlen].tobytes()
+    return target, offset + arlen
+
+def decode_felica(mv, offset, tagtype, rats):
+    tg, prlen, resp_code, nfcid2, pad = FELICA.unpack_from(mv, offset)
+
+    target = Target(tagtype, tg)
+    target.uid = nfcid2
+    target.pad = pad
+    # POL_RES length includes itself, and the system code is optional
+    if prlen - 1 > 1 + 8 + 8:
+        target.system_code, = FELICA_SYSTEM_CODE.unpack_from(mv, offset + FELICA.size)
+
+    return target, offset + 1 + prlen
+
+def decode_jewel(mv, offset, tagtype, rats):
+    tg, sens_res, jewelid = JEWEL.unpack_from(mv, offset)
+
+    target = Target(tagtype, tg)
+    target.sens_res = sens_res
+    target.uid = jewelid
+    return target, offset + JEWEL.size
+
+# By InAutoPoll target type
+DECODERS = {
+    0x00: decode_type_a,
+    0x10: decode_type_a,
+    0x20: decode_type_a,
+    0x23: decode_type_b,
+    0x11: decode_felica,
+    0x12: decode_felica,
+    0x04: decode_jewel,
+}
+
+
+def decode_list(data, tagtype, rats=True):
+    # InListPassiveTarget: NbTg, then each target's data (all the same type)
+    mv = memoryview(bytes(data))
+    decoder = DECODERS.get(tagtype)
+    if decoder is None:
+        raise ValueError('Unknown target type %02x' % tagtype)
+
+    targets = []
+    offset = 1
+    try:
+        for i in range(mv[0]):
+            target, offset = decoder(mv, offset, tagtype, rats)
+            targets.append(target)
+    except (struct.error, IndexError):
+        raise ValueError('Truncated target data')
+
+    if offset > len(mv):
+        raise ValueError('Truncated target data')
+    return targets
+
+def decode_autopoll(data, rats=True):
+    """
+    InAutoPoll: NbTg, then type, length and data for each target.
+
+    >>> target, = decode_autopoll([0x01, 0x10, 0x09,
+    ...                            0x01, 0x00, 0x04, 0x08, 0x04, 0xde, 0xad, 0xbe, 0xef])
+    >>> target
+    <Target 10 (1): deadbeef>
+    >>> target.sens_res, target.sel_res, target.ats
+    (4, 8, None)
+
+    A target that's cut short, or of a type we don't know, is an error
+    rather than a shorter list.
+
+    >>> decode_autopoll([0x01, 0x10, 0x09, 0x01, 0x00])
+    Traceback (most recent call last):
+        ...
+    ValueError: Truncated target data
+    >>> decode_autopoll([0x01, 0x10, 0x05,
+    ...                  0x01, 0x00, 0x04, 0x08, 0x04, 0xde, 0xad, 0xbe, 0xef])
+    Traceback (most recent call last):
+        ...
+    ValueError: Truncated target data
+    >>> decode_autopoll([0x01, 0x99, 0x01, 0x01])
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown target type 99
+    """
+    mv = memoryview(bytes(data))
+
+    targets = []
+    offset = 1
+    try:
+        for i in range(mv[0]):
+            tagtype = mv[offset]
+            end = offset + 2 + mv[offset + 1]
+
+            decoder = DECODERS.get(tagtype)
+            if decoder is None:
+                raise ValueError('Unknown target type %02x' % tagtype)
+
+            target, decoded = decoder(mv[:end], offset + 2, tagtype, rats)
+            if decoded != end:
+                # A UID or ATS length that disagrees with the target's length
+                raise ValueError('Truncated target data')
+            targets.append(target)
+            offset = end
+    except (struct.error, IndexError):
+        raise ValueError('Truncated target data')
+
+    if offset > len(mv):
+        raise ValueError('Truncated target data')
+    return targets
+
+def decode_status(data):
+    # GetGeneralStatus: Err, Field, NbTg, 4 bytes per target, SAM status
+    mv = memoryview(bytes(data))
+    if len(mv) < 3:
+        raise ValueError('Truncated status')
+
+    err, field, nbtg = mv[0], mv[1], mv[2]
+    end = 3 + nbtg * STATUS_TARGET.size
+    if len(mv) < end + 1:
+        raise ValueError('Truncated status')
+
+    targets = list(STATUS_TARGET.iter_unpack(mv[3:end]))
+    sam = mv[end]
+    return err, field, targets, sam
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Decoding speed for synthetic InAutoPoll responses.
+
+Compares targets.decode_autopoll with the byte-by-byte iterator
+decoding Pn532 used to do. The old decoder produced lists and hex UIDs
+directly, so the new one is timed together with the conversion that
+Pn532.make_tag does for autoscan. Creating the Tag itself costs the same
+either way, so neither path includes it.
+
+Usage: python tools/bench_frames.py [frames]
+"""
+
+import importlib
+import os
+import random
+import sys
+import timeit
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARENT, PACKAGE = os.path.split(PACKAGE_DIR)
+
+sys.path.insert(0, PARENT)
+targets = importlib.import_module('%s.targets' % PACKAGE)
+
+
+def randbytes(n):
+    return [random.randrange(0x100) for i in range(n)]
+
+def type_a(tg):
+    ats = [0x78, 0x80, 0x70, 0x02] + randbytes(random.randrange(0, 12))
+    data = [tg, 0x00, 0x04, 0x20, 7] + randbytes(7) + [len(ats) + 1] + ats
+    return [0x20, len(data)] + data
+
+def type_b(tg):
+    data = [tg, 0x50] + randbytes(11) + [1, 0x00]
+    return [0x23, len(data)] + data
+
+def felica(tg):
+    pol_res = [0x01] + randbytes(16) + [0x12, 0xfc]
+    data = [tg, len(pol_res) + 1] + pol_res
+    return [0x11, len(data)] + data
+
+def jewel(tg):
+    data = [tg, 0x0c, 0x00] + randbytes(4)
+    return [0x04, len(data)] + data
+
+def frame():
+    makers = [type_a, type_b, felica, jewel]
+    nbtg = random.choice([1, 1, 1, 2])
+    resp = [nbtg]
+    for tg in range(1, nbtg + 1):
+        resp += random.choice(makers)(tg)
+    return resp
+
+
+# What Pn532.autoscan and parse_tag did before
+def iterator_autopoll(resp):
+    r = iter(resp)
+    nbtg = next(r)
+    tags = []
+    for i in range(nbtg):
+        tagtype = next(r)
+        length = next(r)
+        taginfo = [next(r) for i in range(length)]
+        tags.append(iterator_target(tagtype, iter(taginfo)))
+    return tags
+
+def iterator_target(tagtype, r):
+    target = next(r)
+    info = dict(target=target)
+    if tagtype in (0x10, 0x20):
+        info['sens_res'] = (next(r) << 8) + next(r)
+        info['sel_res'] = next(r)
+        uidlen = next(r)
+        info['uid'] = ''.join('%02x' % next(r) for i in range(uidlen))
+        if tagtype == 0x20:
+            atslen = next(r)
+            info['ats'] = [next(r) for i in range(atslen - 1)]
+    elif tagtype == 0x23:
+        info['atqb'] = [next(r) for i in range(12)]
+        arlen = next(r)
+        info['attrib_res'] = [next(r) for i in range(arlen)]
+    elif tagtype in (0x11, 0x12):
+        prlen = next(r)
+        p = iter([next(r) for i in range(prlen - 1)])
+        resp_code = next(p)
+        info['uid'] = ''.join('%02x' % next(p) for i in range(8))
+        info['pad'] = [next(p) for i in range(8)]
+        info['system_code'] = list(p)
+    elif tagtype == 0x4:
+        info['sens_res'] = (next(r) << 8) + next(r)
+        info['uid'] = ''.join('%02x' % next(r) for i in range(4))
+    return info
+
+
+# What Pn532.make_tag does with each Target, apart from creating the Tag
+def struct_autopoll(resp):
+    tags = []
+    for target in targets.decode_autopoll(resp):
+        info = dict(target=target.logical_id)
+        tagtype = target.type
+        if tagtype in (0x00, 0x10, 0x20):
+            info['sens_res'] = target.sens_res
+            info['sel_res'] = target.sel_res
+            if target.ats is not None:
+                info['ats'] = list(target.ats)
+        elif tagtype == 0x23:
+            info['atqb'] = atqb = list(target.atqb)
+            info['app_data'] = atqb[5:9]
+            info['protocol_info'] = atqb[9:12]
+            info['attrib_res'] = list(target.attrib_res)
+        elif tagtype in (0x11, 0x12):
+            info['pad'] = list(target.pad)
+            info['system_code'] = target.system_code
+        elif tagtype == 0x4:
+            info['sens_res'] = target.sens_res
+        info['uid'] = target.uid.hex()
+        tags.append(info)
+    return tags
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    random.seed(0)
+    frames = [frame() for i in range(count)]
+
+    for name, decode in [
+        ('iterator', iterator_autopoll),
+        ('struct/memoryview', targets.decode_autopoll),
+        ('struct + make_tag', struct_autopoll),
+    ]:
+        elapsed = min(timeit.repeat(lambda: [decode(f) for f in frames], number=1, repeat=5))
+        print('%-18s %6.2fus per frame' % (name, elapsed / count * 1e6))
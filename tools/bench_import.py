@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Cold import times for the parsers, compared with the reader backend.
+
+Each import is timed in a fresh interpreter, as that's what a forked
+worker or CLI tool pays. Usage: python tools/bench_import.py [runs]
+"""
+
+import os
+import subprocess
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARENT, PACKAGE = os.path.split(PACKAGE_DIR)
+
+CASES = [
+    ('ber', 'import %s.ber'),
+    ('apdu', 'import %s.apdu'),
+    ('emv', 'import %s.emv'),
+    ('tag', 'import %s.tag'),
+    ('rfid (backend)', 'import %s.rfid'),
+]
+
+SNIPPET = """
+import sys, time
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+print('%%f %%d' %% (elapsed, 'smartcard' in sys.modules))
+"""
+
+def bench(stmt, runs):
+    times = []
+    pyscard = False
+    for i in range(runs):
+        proc = subprocess.run(
+            [sys.executable, '-c', SNIPPET % stmt],
+            cwd=PARENT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode:
+            return None, proc.stderr.strip().splitlines()[-1]
+
+        elapsed, pyscard = proc.stdout.split()
+        times.append(float(elapsed))
+
+    times.sort()
+    return times[len(times) // 2], bool(int(pyscard))
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    print('Median of %d cold imports' % runs)
+    for name, stmt in CASES:
+        elapsed, pyscard = bench(stmt % PACKAGE, runs)
+        if elapsed is None:
+            print('  %-16s failed: %s' % (name, pyscard))
+            continue
+        print('  %-16s %7.2fms%s' % (name, elapsed * 1000, '  (loads pyscard)' if pyscard else ''))